@@ -38,6 +38,9 @@ setup(name='sviit',
     packages=['sviit'],
     zip_safe=False,
     install_requires=read_requirements("requirements.txt"),
+    extras_require={
+        'numpy': ['numpy'],
+    },
     entry_points = {
         'console_scripts': ['sviit=sviit.cli:main']
     }
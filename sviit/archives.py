@@ -0,0 +1,93 @@
+import queue
+import posixpath
+import tarfile
+import zipfile
+import threading
+from typing import Iterable, Iterator, Tuple, TypeVar
+
+from sviit.disk import SIZE_SS, SIZE_DS
+
+"""
+Reads disk images straight out of zip and tar archives, without unpacking them first.
+
+Members are read in archive order, and members that don't have the size of a disk image are skipped
+without being read (as far as the archive format allows; a compressed tar stream still has to be
+decompressed past them). Reading happens on a separate thread a few members ahead of whoever uses them.
+"""
+
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+IMAGE_SIZES = (SIZE_SS, SIZE_DS)
+READ_AHEAD = 8
+
+T = TypeVar("T")
+
+
+def is_archive(filename: str) -> bool:
+    return filename.lower().endswith(ARCHIVE_EXTENSIONS)
+
+def iter_zip_images(filename: str) -> Iterator[Tuple[str, bytes]]:
+    with zipfile.ZipFile(filename) as archive:
+        for info in archive.infolist():
+            if not info.is_dir() and info.file_size in IMAGE_SIZES:
+                yield info.filename, archive.read(info)
+
+def iter_tar_images(filename: str) -> Iterator[Tuple[str, bytes]]:
+    # Stream mode, so a compressed archive is decompressed once from start to end
+    with tarfile.open(filename, "r|*") as archive:
+        for member in archive:
+            if member.isfile() and member.size in IMAGE_SIZES:
+                yield posixpath.normpath(member.name), archive.extractfile(member).read()
+
+def iter_archive_images(filename: str) -> Iterator[Tuple[str, bytes]]:
+    # The name and contents of each disk image in a zip or tar archive
+    if filename.lower().endswith('.zip'):
+        return iter_zip_images(filename)
+    return iter_tar_images(filename)
+
+def read_ahead(items: Iterable[T], size: int=READ_AHEAD) -> Iterator[T]:
+    # Produces the items on a background thread, at most size items ahead of the consumer
+    buffer: "queue.Queue" = queue.Queue(maxsize=size)
+    done = object()
+    stop = threading.Event()
+
+    def put(entry) -> bool:
+        while not stop.is_set():
+            try:
+                buffer.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        iterator = iter(items)
+        try:
+            for item in iterator:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except BaseException as e:
+            put((done, e))
+        finally:
+            # Closes the archive of a generator that wasn't run to the end
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                break
+            yield item
+    finally:
+        # The consumer may stop early, which must not leave the producer blocked on a full buffer
+        stop.set()
+        thread.join()
+
+def archive_images(filename: str, size: int=READ_AHEAD) -> Iterator[Tuple[str, bytes]]:
+    return read_ahead(iter_archive_images(filename), size)
@@ -1,30 +1,92 @@
+import builtins
+import decimal
+import fractions
+import functools
 import logging
+import re
 from sviit.disk import Disk
 from sviit import util
 
+# Increase whenever the detokenized output changes, so previously extracted programs are regenerated
+TOKENIZER_VERSION = 2
+
 def read_word(bytes, pos):
     return bytes[pos] + bytes[pos+1] * 256
 
 def read_float(bytes):
-    num = 0
-    for b in bytes[1:]:
-        num = num * 10 + b / 16
-        num = num * 10 + b % 16
-    while num >= 1:
-        num /= 10.0
-    num = num * 10 ** (bytes[0] - 0x40)
-    return num
+    return float(decode_float(builtins.bytes(bytes)))
 
 def format_float(num):
     return "%.14g" % num
 
+@functools.lru_cache(maxsize=4096)
+def decode_float(bytes):
+    # Decodes a BCD float (4 bytes single or 8 bytes double precision) exactly, formatted like "%.14g".
+    # The first byte is the sign bit and the exponent (excess 64), followed by two mantissa digits per byte.
+    exponent = bytes[0]
+    sign = '-' if exponent & 0x80 else ''
+    exponent = (exponent & 0x7F) - 0x40
+
+    digits = "".join(_BCD_DIGITS[b] or "?" for b in bytes[1:])
+    if "?" in digits:
+        # Not valid BCD, so weigh each nibble as a digit anyway
+        mantissa = 0
+        for b in bytes[1:]:
+            mantissa = (mantissa * 10 + b // 16) * 10 + b % 16
+        num = fractions.Fraction(mantissa) * fractions.Fraction(10) ** (exponent - 2 * (len(bytes) - 1))
+        return sign + format_float(num)
+
+    stripped = digits.lstrip('0')
+    exponent -= len(digits) - len(stripped)
+    stripped = stripped.rstrip('0')
+    if not stripped or bytes[0] == 0:
+        return "0"
+
+    # Same layout as "%.14g": value is 0.<stripped> * 10^exponent
+    exponent -= 1
+    if -4 <= exponent < 14:
+        if exponent < 0:
+            return "%s0.%s%s" % (sign, '0' * (-exponent - 1), stripped)
+        whole = stripped[:exponent+1].ljust(exponent + 1, '0')
+        fraction = stripped[exponent+1:]
+        return "%s%s.%s" % (sign, whole, fraction) if fraction else sign + whole
+    mantissa = "%s.%s" % (stripped[0], stripped[1:]) if len(stripped) > 1 else stripped
+    return "%s%se%+03d" % (sign, mantissa, exponent)
+
+_BCD_DIGITS = ["%d%d" % (b // 16, b % 16) if b // 16 < 10 and b % 16 < 10 else None for b in range(256)]
+
 def detokenize(bytes, swechars=False):
+    return [line for _, line in iter_detokenize(bytes, swechars)]
+
+def iter_detokenize(bytes, swechars=False):
+    # Yields (line number, line) for one line at a time. The line number is None for lines that couldn't be decoded.
+    for line_number, pieces, diagnostic in _iter_decoded_lines(bytes, swechars):
+        yield line_number, "".join(pieces) + diagnostic
+
+def iter_tokens(bytes, swechars=False):
+    # Like iter_detokenize, but also yields the tokens of each line: keywords, names, constants, words in
+    # strings and comments, and any other characters, all in upper case.
+    for line_number, pieces, diagnostic in _iter_decoded_lines(bytes, swechars):
+        tokens = []
+        if line_number is not None:
+            for piece in pieces[1:]:
+                tokens.extend(split_words(piece))
+        yield line_number, "".join(pieces) + diagnostic, tokens
+
+def split_words(text):
+    # Splits detokenized text into the tokens used by iter_tokens
+    return _WORD.findall(text.upper())
+
+def _iter_decoded_lines(bytes, swechars):
     if type(bytes) is str:
-        bytes = [ord(x) for x in bytes]
-    lines = []
+        bytes = bytes.encode("latin-1")
+    elif type(bytes) is not builtins.bytes:
+        # Indexing bytes is cheaper than indexing a memoryview, so take the one copy up front
+        bytes = builtins.bytes(bytes)
     pos = 0
+    size = len(bytes)
     while True:
-        if pos + 2 > len(bytes):
+        if pos + 2 > size:
             logging.warning("Program ended abruptly")
             break
         next_row = read_word(bytes, pos)
@@ -33,83 +95,306 @@ def detokenize(bytes, swechars=False):
             break
         next_row -= 32769  # Program is loaded into 0x8001
         if next_row < pos+4:
-            lines.append("*** UNEXPECTED EOF")
+            yield None, ["*** UNEXPECTED EOF"], ""
             logging.warning("Invalid line pointer, aborting tokenizing")
             break
-        lines.append(detokenize_line(bytes[pos+2:next_row], swechars))
+        yield _decode_line(bytes, pos+2, min(next_row, size), swechars)
         pos = next_row
-    return lines
 
 def detokenize_line(bytes, swechars=False):
-    if len(bytes) < 2:
+    _, pieces, diagnostic = _decode_line(builtins.bytes(bytes), 0, len(bytes), swechars)
+    return "".join(pieces) + diagnostic
+
+def _decode_line(data, start, end, swechars):
+    # Decodes the line in data[start:end] without slicing it. Every byte is looked up in the dispatch table,
+    # which holds either the string to emit or a handler that decodes the token and returns the new position.
+    # Returns the line number, the decoded pieces of the line and a diagnostic to add if the line is broken.
+    if end - start < 2:
         logging.warning("Line less than two bytes, skipping")
-        return "*** UNEXPECTED EOL"
-    line_number = read_word(bytes, 0)
-    #print ["%02x" % x for x in bytes]
-
-    line = '%d ' % line_number
-    pos = 2
-    while pos < len(bytes) and bytes[pos] != 0:
-        token = bytes[pos]
-        pos += 1
-        if token >= 32 and token < 127:
-            if swechars:
-                line += util.token_to_swechar(token)
+        return None, ["*** UNEXPECTED EOL"], ""
+    line_number = data[start] + data[start+1] * 256
+
+    table = _DISPATCH_SWECHARS if swechars else _DISPATCH
+    pieces = ['%d ' % line_number]
+    append = pieces.append
+    pos = start + 2
+    while pos < end:
+        token = data[pos]
+        if token == 0:
+            break
+        entry = table[token]
+        if entry.__class__ is str:
+            pos += 1
+            if 32 <= token < 127 and pos < end and 32 <= data[pos] < 127:
+                # Copy the whole run of plain characters (strings, comments, names) at once
+                run_end = _LITERAL_RUN.match(data, pos, end).end()
+                if swechars:
+                    append(data[pos-1:run_end].translate(_SWECHARS_TRANSLATION).decode("latin-1"))
+                else:
+                    append(data[pos-1:run_end].decode("ascii"))
+                pos = run_end
             else:
-                line += chr(token)
+                append(entry)
+        else:
+            pos = entry(data, pos + 1, end, pieces, line_number)
+
+    diagnostic = ""
+    if pos >= end:
+        diagnostic = " *** BUFFER ENDED PREMATURELY"
+        logging.warning("Buffer ended before EOL token on line number %d" % line_number)
+    elif pos + 1 != end:
+        diagnostic = " *** GOT EOL BUT BUFFER NOT EMPTY"
+        logging.warning("Got EOL token on line number %d but not end of buffer" % line_number)
+
+    return line_number, pieces, diagnostic
+
+def _check_operand(pos, size, end):
+    # Operands may not extend past the end of the line
+    if pos + size > end:
+        raise IndexError("index out of range")
+
+def _hex_constant(data, pos, end, pieces, line_number):
+    _check_operand(pos, 2, end)
+    pieces.append("&H%X" % (data[pos] + data[pos+1] * 256))
+    return pos + 2
+
+def _word_constant(data, pos, end, pieces, line_number):
+    # Tokens 14 and 28 are decoded the same way
+    _check_operand(pos, 2, end)
+    pieces.append("%d" % (data[pos] + data[pos+1] * 256))
+    return pos + 2
+
+def _byte_constant(data, pos, end, pieces, line_number):
+    _check_operand(pos, 1, end)
+    pieces.append("%d" % data[pos])
+    return pos + 1
+
+def _single_constant(data, pos, end, pieces, line_number):
+    pieces.append("%s!" % decode_float(data[pos:min(pos+4, end)]))
+    return pos + 4
+
+def _double_constant(data, pos, end, pieces, line_number):
+    pieces.append("%s#" % decode_float(data[pos:min(pos+8, end)]))
+    return pos + 8
+
+def _unknown_control(data, pos, end, pieces, line_number):
+    _check_operand(pos, 1, end)
+    raise Exception("Unknown token %d on line number %d" % (data[pos], line_number))
+
+def _unknown_token(token):
+    def handler(data, pos, end, pieces, line_number):
+        raise Exception("Unknown token %d on line number %d" % (token, line_number))
+    return handler
+
+def _apostrophe(data, pos, end, pieces, line_number):
+    # When using apostroph as comments, it's encoded :REM'
+    # We need to remove the previous four characters to get same decoding
+    # TODO: There's something more to this. The rest of the characters are never tokens?
+    logging.warning("Apostroph comments")
+    remove = 4
+    while remove and pieces:
+        piece = pieces.pop()
+        if len(piece) > remove:
+            pieces.append(piece[:-remove])
+            break
+        remove -= len(piece)
+    pieces.append("'")
+    return pos
+
+def _extended_token(data, pos, end, pieces, line_number):
+    _check_operand(pos, 1, end)
+    token = data[pos] % 128
+    s = TOKENS[token]
+    if len(s) == 0:
+        raise Exception("Unknown token %d on line number %d" % (token, line_number))
+    pieces.append(s)
+    return pos + 1
+
+def _build_dispatch_table(swechars):
+    table = []
+    for token in range(256):
+        if token >= 32 and token < 127:
+            table.append(util.token_to_swechar(token) if swechars else chr(token))
         elif token == 12:
-            line += "&H%X" % read_word(bytes, pos)
-            pos += 2
-        elif token == 14:
-            # Same as 28!?
-            # Positive numebr?
-            line += "%d" % read_word(bytes, pos)
-            pos += 2
+            table.append(_hex_constant)
+        elif token == 14 or token == 28:
+            table.append(_word_constant)
         elif token == 15:
-            line += "%d" % bytes[pos]
-            pos += 1
+            table.append(_byte_constant)
         elif token >= 17 and token < 27:
-            line += "%d" % (token - 17)
-        elif token == 28:
-            # Same as 14!?
-            # Negative number? (but minus sign is still explicit before)
-            line += "%d" % read_word(bytes, pos)
-            pos += 2
+            table.append("%d" % (token - 17))
         elif token == 29:
-            line += "%s!" % format_float(read_float(bytes[pos:pos+4]))
-            pos += 4
+            table.append(_single_constant)
         elif token == 31:
-            line += "%s#" % format_float(read_float(bytes[pos:pos+8]))
-            pos += 8
+            table.append(_double_constant)
         elif token < 32:
-            raise Exception("Unknown token %d on line number %d" % (bytes[pos], line_number))
-        else:
+            table.append(_unknown_control)
+        elif token == 255:
             # TODO: Graphical characters!
-            if token == 255:
-                token = bytes[pos] % 128
-                pos += 1
-            if token == 0xe6:
-                # When using apostroph as comments, it's encoded :REM'
-                # We need to remove the previous four characters to get same decoding
-                # TODO: There's something more to this. The rest of the characters are never tokens?
-                logging.warning("Apostroph comments")
-                line = "%s'" % line[:-4]
-            else:
-                s = TOKENS[token]
-                if len(s) == 0:
-                    raise Exception("Unknown token %d on line number %d" % (token, line_number))
-                else:
-                    line += TOKENS[token]
+            table.append(_extended_token)
+        elif token == 0xe6:
+            table.append(_apostrophe)
+        elif len(TOKENS[token]) == 0:
+            table.append(_unknown_token(token))
+        else:
+            table.append(TOKENS[token])
+    return table
 
-    if pos >= len(bytes):
-        line += " *** BUFFER ENDED PREMATURELY"
-        logging.warning("Buffer ended before EOL token on line number %d" % line_number)
-    elif pos + 1 != len(bytes):
-        line += " *** GOT EOL BUT BUFFER NOT EMPTY"
-        logging.warning("Got EOL token on line number %d but not end of buffer" % line_number)
+def tokenize(lines, swechars=False):
+    # The inverse of detokenize: turns a program listing into the tokenized format loaded at 0x8001
+    program = bytearray()
+    for line in lines:
+        if not line.strip():
+            continue
+        tokenized = tokenize_line(line.rstrip("\r\n"), swechars)
+        next_row = 0x8001 + len(program) + 2 + len(tokenized)
+        if next_row > 0xFFFF:
+            raise Exception("Program too large")
+        program += _word(next_row)
+        program += tokenized
+    program += b"\0\0"
+    return builtins.bytes(program)
+
+def tokenize_line(line, swechars=False):
+    # Returns the line number and the tokens of one line, ending with the EOL token (but without the line pointer)
+    if swechars:
+        line = util.str_from_swechar(line)
+    m = _LINE_NUMBER.match(line)
+    if not m:
+        raise Exception("Missing line number: %s" % line)
+    line_number = int(m.group(1))
+    if line_number > 65529:
+        raise Exception("Invalid line number %d" % line_number)
+
+    out = bytearray(_word(line_number))
+    pos = m.end()
+    size = len(line)
+    in_identifier = False  # Digits following a letter are part of a variable name
+    line_refs = False  # Numbers following GOTO etc. are line numbers
+    while pos < size:
+        c = line[pos]
+        if c == '"':
+            end = line.find('"', pos + 1)
+            end = size if end < 0 else end + 1
+            _append_literal(out, line, pos, end)
+            pos = end
+            in_identifier = line_refs = False
+            continue
+        if c == "'":
+            out += b":\x8f\xe6"
+            _append_literal(out, line, pos + 1, size)
+            break
+        if not in_identifier and (c.isdigit() or (c == '.' and line[pos+1:pos+2].isdigit())):
+            m = _NUMBER.match(line, pos)
+            out += _encode_number(m.group(0), line_refs)
+            pos = m.end()
+            continue
+        if c == '&' and line[pos+1:pos+2] in ('H', 'h'):
+            m = _HEX_NUMBER.match(line, pos)
+            if m:
+                value = int(m.group(1), 16)
+                if value > 0xFFFF:
+                    raise Exception("Hex constant out of range on line number %d" % line_number)
+                out += b"\x0c" + _word(value)
+                pos = m.end()
+                in_identifier = line_refs = False
+                continue
+
+        # Longest keyword match starting at this position
+        node = _KEYWORD_TRIE
+        match = None
+        i = pos
+        while i < size:
+            node = node.get(line[i].upper())
+            if node is None:
+                break
+            i += 1
+            if _TRIE_END in node:
+                match = i, node[_TRIE_END]
+        if match:
+            keyword_end, token = match
+            out += token
+            pos = keyword_end
+            in_identifier = False
+            if token == b"\x8f":  # REM
+                _append_literal(out, line, pos, size)
+                break
+            if token == b"\x84":  # DATA
+                end = _DATA_END.match(line, pos).end()
+                _append_literal(out, line, pos, end)
+                pos = end
+            line_refs = token in _LINE_REF_TOKENS or (line_refs and token == b"\xf4")
+            continue
+
+        if ord(c) < 32 or ord(c) >= 127:
+            raise Exception("Can't tokenize character %r on line number %d" % (c, line_number))
+        out.append(ord(c))
+        in_identifier = c.isalpha() or (in_identifier and c.isdigit())
+        line_refs = line_refs and c in " ,"
+        pos += 1
 
-    #print line
-    return line
+    out.append(0)
+    return builtins.bytes(out)
+
+def encode_float(text, double=False):
+    # Encodes a decimal number as a BCD float, rounding to 6 (single) or 14 (double precision) digits
+    num = decimal.Decimal(text)
+    num_digits = 14 if double else 6
+    if num.is_zero():
+        return builtins.bytes(1 + num_digits // 2)
+    num = decimal.Context(prec=num_digits, rounding=decimal.ROUND_HALF_UP).plus(num)
+    sign, digits, exponent = num.as_tuple()
+    exponent += len(digits) + 0x40  # Value is 0.<digits> * 10^exponent
+    if exponent < 1 or exponent > 0x7F:
+        raise Exception("Float constant out of range: %s" % text)
+    digits = (digits + (0,) * num_digits)[:num_digits]
+    return builtins.bytes([exponent | (0x80 if sign else 0)] + [digits[i] * 16 + digits[i+1] for i in range(0, num_digits, 2)])
+
+def _encode_number(text, line_ref=False):
+    suffix = text[-1] if text[-1] in "!#" else ""
+    body = text[:len(text) - len(suffix)]
+    if not suffix and body.isdigit():
+        value = int(body)
+        if line_ref and value <= 65529:
+            return b"\x0e" + _word(value)
+        if value < 10:
+            return builtins.bytes([17 + value])
+        if value < 256:
+            return builtins.bytes([15, value])
+        if value < 32768:
+            return b"\x1c" + _word(value)
+    double = suffix == "#" or "D" in body or "d" in body
+    if not suffix and not double:
+        # Like the SVI, use double precision for constants that don't fit in a single
+        double = len(body.replace(".", "").lstrip("0").split("E")[0].split("e")[0]) > 6
+    body = body.replace("D", "E").replace("d", "E")
+    if double:
+        return b"\x1f" + encode_float(body, True)
+    return b"\x1d" + encode_float(body, False)
+
+def _append_literal(out, line, start, end):
+    for c in line[start:end]:
+        if ord(c) > 255:
+            raise Exception("Can't tokenize character %r" % c)
+        out.append(ord(c))
+
+def _word(value):
+    return builtins.bytes([value % 256, value // 256])
+
+def _build_keyword_trie():
+    # Maps each keyword, one character at a time, to its token. Where a keyword appears twice, the first one is used.
+    keywords = [(token, builtins.bytes([token])) for token in range(128, 255) if token != 0xe6]
+    keywords += [(token, builtins.bytes([255, 128 + token])) for token in range(1, 128)]
+    trie = {}
+    for token, encoded in keywords:
+        keyword = TOKENS[token]
+        if not keyword:
+            continue
+        node = trie
+        for c in keyword:
+            node = node.setdefault(c, {})
+        node.setdefault(_TRIE_END, encoded)
+    return trie
 
 TOKENS = [
     '', 'LEFT$', 'RIGHT$', 'MID$', 'SGN', 'INT', 'ABS', 'SQR', 'RND', 'SIN', 'LOG', 'EXP', 'COS', 'TAN', 'ATN', 'FRE',
@@ -130,6 +415,22 @@ TOKENS = [
     '>', '=', '<', '+', '-', '*', '/', '^', 'AND', 'OR', 'XOR', 'EQV', 'IMP', 'MOD', '\\', ''
 ]
 
+_LITERAL_RUN = re.compile(rb"[\x20-\x7e]+")
+_WORD = re.compile(r"&H[0-9A-F]+|[0-9.]+(?:E[+-]?[0-9]+)?[!#%]?|[A-Z\x80-\xff][A-Z0-9\x80-\xff]*[$%!#]?|\S")
+_SWECHARS_TRANSLATION = util.SWECHAR_BYTES_TRANSLATION
+_DISPATCH = _build_dispatch_table(False)
+_DISPATCH_SWECHARS = _build_dispatch_table(True)
+
+_LINE_NUMBER = re.compile(r"\s*(\d+) ?")
+_NUMBER = re.compile(r"(?:\d+\.?\d*|\.\d+)(?:[EeDd][+-]?\d+)?[!#]?")
+_HEX_NUMBER = re.compile(r"&[Hh]([0-9A-Fa-f]+)")
+_DATA_END = re.compile(r'(?:"[^"]*"?|[^:"])*')
+_TRIE_END = None
+_KEYWORD_TRIE = _build_keyword_trie()
+# Keywords that may be followed by line numbers
+LINE_REF_KEYWORDS = ['GOTO', 'GOSUB', 'THEN', 'ELSE', 'RESTORE', 'RUN', 'RESUME', 'LIST', 'LLIST', 'DELETE', 'RENUM', 'AUTO']
+_LINE_REF_TOKENS = set(builtins.bytes([TOKENS.index(keyword)]) for keyword in LINE_REF_KEYWORDS)
+
 def main():
     disk = Disk('/Users/yarin/Dropbox/SVI/ripped/disk/musik.dsk')
     data = disk.read_file('rem')
@@ -0,0 +1,162 @@
+import os
+import os.path
+import io
+import sys
+import json
+import time
+import timeit
+import logging
+import platform
+import statistics
+import contextlib
+import subprocess
+import tempfile
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sviit.disk import Disk
+from sviit import basic_tokenizer, disk_viewer, synthetic
+
+"""
+Benchmarks of the hot paths, run on synthetic disk images so the results only depend on the code.
+
+Each benchmark is timed a number of rounds and the results are saved as JSON, together with the commit
+and Python version, so a run can be compared with one from an earlier commit.
+"""
+
+RESULTS_VERSION = 1
+
+# Name and a function that takes the directory with the test images and returns the function to time
+Benchmark = Tuple[str, Callable[[str], Callable[[], object]]]
+
+
+def _image(workdir: str, double_sided=False) -> str:
+    return os.path.join(workdir, "ds.dsk" if double_sided else "ss.dsk")
+
+def _bench_load(double_sided):
+    def setup(workdir):
+        filename = _image(workdir, double_sided)
+        return lambda: Disk(filename)
+    return setup
+
+def _bench_get_all_files(workdir):
+    disk = Disk(_image(workdir, True))
+
+    def run():
+        # The parsed directory is cached on the disk, so it has to be dropped to parse it again
+        disk._invalidate_caches()
+        return disk.get_all_files()
+    return run
+
+def _bench_read(workdir):
+    files = Disk(_image(workdir, True)).get_all_files()
+    return lambda: [f.read() for f in files]
+
+def _bench_detokenize(workdir):
+    data = [f.read() for f in Disk(_image(workdir, True)).get_files() if f.is_basic_file()]
+    return lambda: [basic_tokenizer.detokenize(program) for program in data]
+
+def _bench_read_float(workdir):
+    values = []
+    for i in range(2000):
+        values.append(basic_tokenizer.encode_float("%d.%06d" % (i, i * 7919 % 1000000), True))
+        values.append(basic_tokenizer.encode_float("%de-%d" % (i, i % 30), False))
+
+    def run():
+        # Decoded floats are cached, so start from an empty cache
+        basic_tokenizer.decode_float.cache_clear()
+        return [basic_tokenizer.read_float(value) for value in values]
+    return run
+
+def _bench_show(workdir):
+    filename = _image(workdir, True)
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            disk_viewer.show(filename)
+    return run
+
+def _bench_save(workdir):
+    disk = Disk(_image(workdir, True))
+    output = os.path.join(workdir, "saved.dsk")
+
+    def run():
+        # Saving again to the same file only writes changed tracks, so always start over with a new file
+        if os.path.exists(output):
+            os.unlink(output)
+        disk.save_to_file(output)
+    return run
+
+def _bench_save_changed(workdir):
+    output = os.path.join(workdir, "changed.dsk")
+    disk = Disk(_image(workdir, True))
+    disk.save_to_file(output)
+
+    def run():
+        with disk.edit() as tx:
+            tx.write_track(30, b"changed")
+        disk.save_to_file(output)
+    return run
+
+BENCHMARKS: List[Benchmark] = [
+    ("load_from_file_ss", _bench_load(False)),
+    ("load_from_file_ds", _bench_load(True)),
+    ("get_all_files", _bench_get_all_files),
+    ("file_read", _bench_read),
+    ("detokenize", _bench_detokenize),
+    ("read_float", _bench_read_float),
+    ("disk_viewer_show", _bench_show),
+    ("save_to_file", _bench_save),
+    ("save_to_file_changed", _bench_save_changed),
+]
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(__file__),
+                                       stderr=subprocess.DEVNULL).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(rounds: int=5, seed: int=0, selected: Optional[List[str]]=None) -> Dict:
+    # Runs the benchmarks whose names start with any of the selected strings, or all of them.
+    # Times are seconds per call.
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        synthetic.write_image(_image(workdir, False), seed, False)
+        synthetic.write_image(_image(workdir, True), seed, True, num_programs=20)
+        # The synthetic images have broken files on purpose, which shouldn't flood the output
+        logging.disable(logging.WARNING)
+        try:
+            for name, setup in BENCHMARKS:
+                if selected and not any(name.startswith(s) for s in selected):
+                    continue
+                timer = timeit.Timer(setup(workdir))
+                number, _ = timer.autorange()
+                times = [t / number for t in timer.repeat(rounds, number)]
+                results[name] = {"best": min(times), "median": statistics.median(times), "number": number}
+        finally:
+            logging.disable(logging.NOTSET)
+    return {
+        "version": RESULTS_VERSION,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "seed": seed,
+        "benchmarks": results,
+    }
+
+def compare(old: Dict, new: Dict) -> List[Tuple[str, Optional[float], Optional[float]]]:
+    # The best time of each benchmark in both runs; None where a run doesn't have the benchmark
+    names = list(new["benchmarks"]) + [name for name in old["benchmarks"] if name not in new["benchmarks"]]
+    return [(name, old["benchmarks"].get(name, {}).get("best"), new["benchmarks"].get(name, {}).get("best"))
+            for name in names]
+
+def load_results(filename: str) -> Dict:
+    with open(filename) as f:
+        return json.load(f)
+
+def save_results(results: Dict, filename: str):
+    with open(filename, "w") as f:
+        json.dump(results, f, indent=2)
+        f.write("\n")
@@ -0,0 +1,195 @@
+import re
+import mmap
+import struct
+import fnmatch
+from array import array
+from typing import Iterator, List, Optional, Tuple
+
+from sviit.disk import Disk, ENCODING
+from sviit.util import atomic_write
+from sviit.images import ImageWorker, Source, iter_sources, map_images, open_image
+
+"""
+A catalog of the directory entries of every disk image in a collection, in a single file.
+
+The entries are stored column by column (image, name, type, size, deleted flag and where the chain of
+tracks starts in one array of all chains), each column as a plain array of fixed size values. Opening a
+catalog maps the file into memory and uses the columns where they are, so queries start immediately and
+only touch the pages of the columns they look at, without opening any disk images.
+
+    header      magic, number of images, number of entries, size of the image names and of the chains
+    image names offset of each image name (num_images + 1 uint32) and the UTF-8 names one after another
+    image       image of each entry (uint32)
+    name        the 9 byte filename of each entry, as in the directory
+    type        file type of each entry (uint8)
+    deleted     1 for deleted entries (uint8)
+    size        size of each entry, -1 if unknown (int32)
+    chain       offset of the chain of each entry in tracks (num_entries + 1 uint32)
+    tracks      the chains one after another (uint8)
+
+Each section starts at a multiple of 8 bytes. Numbers are little endian.
+"""
+
+MAGIC = b"SVIICAT1"
+HEADER = struct.Struct("<8sIIII")
+ALIGNMENT = 8
+NAME_SIZE = 9
+
+# An entry as returned by queries: image, filename, type, size, deleted and tracks
+Entry = Tuple[str, str, int, int, bool, List[int]]
+
+
+def _pad(size: int) -> int:
+    return -size % ALIGNMENT
+
+def _native(column: array) -> array:
+    # The file is little endian whatever the machine is
+    if struct.pack("=I", 1) != struct.pack("<I", 1):
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column
+
+
+class CatalogWriter:
+    # Collects the entries of one image after another in columns, and writes them to a catalog file
+    def __init__(self):
+        self.images: List[str] = []
+        self.image = array('I')
+        self.names = bytearray()
+        self.types = bytearray()
+        self.deleted = bytearray()
+        self.sizes = array('i')
+        self.chain = array('I', [0])
+        self.tracks = array('B')
+
+    def __len__(self):
+        return len(self.image)
+
+    def add_image(self, image: str, entries: List[Tuple[bytes, int, int, bool, bytes]]):
+        # Entries are name, type, size, deleted and tracks
+        image_id = len(self.images)
+        self.images.append(image)
+        for name, file_type, size, deleted, tracks in entries:
+            self.image.append(image_id)
+            self.names += name
+            self.types.append(file_type)
+            self.deleted.append(1 if deleted else 0)
+            self.sizes.append(size)
+            self.tracks.frombytes(tracks)
+            self.chain.append(len(self.tracks))
+
+    def write(self, filename: str):
+        # Written to a temporary file that replaces the catalog when complete, so readers never see half a file
+        names = [image.encode("utf-8") for image in self.images]
+        name_offsets = array('I', [0])
+        for name in names:
+            name_offsets.append(name_offsets[-1] + len(name))
+        sections = [_native(name_offsets), b"".join(names), _native(self.image), self.names, self.types,
+                    self.deleted, _native(self.sizes), _native(self.chain), self.tracks]
+
+        with atomic_write(filename) as tmpname:
+            with open(tmpname, "wb") as f:
+                f.write(HEADER.pack(MAGIC, len(self.images), len(self), name_offsets[-1], len(self.tracks)))
+                f.write(bytes(_pad(HEADER.size)))
+                for section in sections:
+                    data = memoryview(section).cast('B')
+                    f.write(data)
+                    f.write(bytes(_pad(len(data))))
+
+
+class Catalog:
+    def __init__(self, filename: str):
+        with open(filename, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, num_images, num_entries, names_size, tracks_size = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            self._mmap.close()
+            raise Exception("%s is not a catalog" % filename)
+        if struct.pack("=I", 1) != struct.pack("<I", 1):
+            self._mmap.close()
+            raise Exception("Catalogs can only be read on little endian machines")
+
+        data = memoryview(self._mmap)
+        pos = HEADER.size + _pad(HEADER.size)
+
+        def section(size: int, typecode: str='B') -> memoryview:
+            nonlocal pos
+            view = data[pos:pos+size].cast(typecode)
+            pos += size + _pad(size)
+            return view
+
+        self._name_offsets = section(4 * (num_images + 1), 'I')
+        self._image_names = section(names_size)
+        self.image = section(4 * num_entries, 'I')
+        self.names = section(NAME_SIZE * num_entries)
+        self.types = section(num_entries)
+        self.deleted = section(num_entries)
+        self.sizes = section(4 * num_entries, 'i')
+        self.chain = section(4 * (num_entries + 1), 'I')
+        self.tracks = section(tracks_size)
+        self.num_images = num_images
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.image)
+
+    def close(self):
+        # The views on the mapped file have to be released before it can be closed
+        for name in ("_name_offsets", "_image_names", "image", "names", "types", "deleted", "sizes", "chain", "tracks"):
+            view = self.__dict__.pop(name, None)
+            if view is not None:
+                view.release()
+        self._mmap.close()
+
+    def image_name(self, image_id: int) -> str:
+        return bytes(self._image_names[self._name_offsets[image_id]:self._name_offsets[image_id+1]]).decode("utf-8")
+
+    def filename(self, i: int) -> str:
+        return bytes(self.names[i*NAME_SIZE:(i+1)*NAME_SIZE]).decode(ENCODING).strip()
+
+    def entry(self, i: int) -> Entry:
+        return (self.image_name(self.image[i]), self.filename(i), self.types[i], self.sizes[i], bool(self.deleted[i]),
+                self.tracks[self.chain[i]:self.chain[i+1]].tolist())
+
+    def query(self, pattern: Optional[str]=None, basic=False, deleted=False) -> Iterator[Entry]:
+        # Entries whose filename matches a shell style pattern (case insensitive), optionally only BASIC
+        # programs, and only existing files unless deleted is set
+        regex = re.compile(fnmatch.translate(pattern.upper())) if pattern else None
+        for i in range(0, len(self)):
+            if self.deleted[i] and not deleted:
+                continue
+            if basic and (self.types[i] & 0xA1) != 0x80:
+                continue
+            if regex is not None and not regex.match(self.filename(i).upper()):
+                continue
+            yield self.entry(i)
+
+
+def read_entries(disk: Disk) -> List[Tuple[bytes, int, int, bool, bytes]]:
+    # The directory entries of a disk as stored in the catalog
+    if not disk.has_fat():
+        return []
+    return [(f.name.encode(ENCODING)[:NAME_SIZE].ljust(NAME_SIZE), f.type, f.size, f.deleted, f.tracks.tobytes())
+            for f in disk.get_all_files()]
+
+def read_image(image: str, source: Source) -> List[Tuple[bytes, int, int, bool, bytes]]:
+    with open_image(source) as disk:
+        return read_entries(disk)
+
+def build(inpath: str, catalog_file: str, workers: Optional[int]=None) -> Tuple[int, int, List[Tuple[str, str]]]:
+    # Catalogs the directory entries of all disk images in a directory or archive, replacing any previous
+    # catalog. Returns the number of images and entries, and the images that failed.
+    writer = CatalogWriter()
+    failed = []
+    for image, entries, error in map_images(ImageWorker(read_image, "read", []), iter_sources(inpath), workers):
+        if error is not None:
+            failed.append((image, error))
+        else:
+            writer.add_image(image, entries)
+    writer.write(catalog_file)
+    return len(writer.images), len(writer), failed
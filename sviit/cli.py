@@ -1,30 +1,137 @@
 import click
 import click_log
+import contextlib
 import logging
-from sviit import disk_viewer, basic_tokenizer
-from sviit.disk import Disk
+import os.path
+import sys
 
 """
 sviit disk list
 sviit disk view <myfile>
+
+The sviit modules are imported by the commands that use them, so starting the CLI imports almost nothing.
 """
 
 logger = logging.getLogger("sviit_cli")
 click_log.basic_config(logger)
 
+# Opened disk images, when running commands in batch mode
+_disk_cache = None
+
+@contextlib.contextmanager
+def open_disk(source):
+    # A disk image file, or the contents of one. Outside batch mode the disk is closed at the end of the with
+    # block, in batch mode an image file is kept open for the next command to use, as long as it doesn't change.
+    if _disk_cache is None or isinstance(source, bytes):
+        from sviit.images import open_image
+        with open_image(source) as d:
+            yield d
+        return
+    yield _disk_cache.get(source)
+
 @click.group()
-def main():
-    pass
+@click.option("--profile", help="Time each stage of the command and print a summary at exit", default=False, is_flag=True)
+@click.option("--profile-format", help="Format of the profile summary", type=click.Choice(["text", "json"]), default="text")
+@click.option("--profile-output", help="File to write the profile summary to, instead of stderr (implies --profile)")
+@click.option("--cprofile", "cprofile_output", help="File to write cProfile statistics to, for reading with pstats")
+@click.pass_context
+def main(ctx, profile=False, profile_format="text", profile_output=None, cprofile_output=None):
+    if profile or profile_output:
+        from sviit import profiling
+        profiling.enable()
+        # Worker processes aren't measured, so do all the work in this process unless told otherwise
+        ctx.default_map = {
+            "extract": {"workers": 1},
+            "index": {"build": {"workers": 1}},
+            "similar": {"workers": 1},
+            "recover": {"workers": 1},
+            "fsck": {"workers": 1},
+            "catalog": {"build": {"workers": 1}},
+        }
+        ctx.call_on_close(lambda: profiling.dump(profile_format, profile_output))
+    if cprofile_output:
+        import cProfile
+        profiler = cProfile.Profile()
+
+        def stop():
+            profiler.disable()
+            profiler.dump_stats(cprofile_output)
+        ctx.call_on_close(stop)
+        profiler.enable()
+
+def iter_images(images):
+    # The name of each disk image in the given image files, directories and zip/tar archives, and a
+    # context manager that opens it
+    from sviit.images import iter_sources
+    for image in images:
+        for name, source in iter_sources(image):
+            yield (source if isinstance(source, str) else f"{image}/{name}"), open_disk(source)
 
 @main.group()
 def disk():
     pass
 
+@main.command()
+@click.option("--input", "inpath", help='The directory or zip/tar archive to search for disk images', required=True)
+@click.option("--output", "outpath", help='The directory to write the detokenized programs to', required=True)
+@click.option("--workers", help="Number of worker processes (default is the number of CPUs)", type=int, default=None)
+@click.option("--manifest", help="SQLite file remembering previous runs, to only extract what has changed")
+@click.option("--swechars", help="Decode tokens as Swedish characters", default=False, is_flag=True)
+def extract(inpath, outpath, workers=None, manifest=None, swechars=False):
+    from sviit import extract_basic_programs
+    results = extract_basic_programs.extract_all(inpath, outpath, workers, swechars, manifest)
+    failed = [(image, error) for image, _, error in results if error is not None]
+    for image, error in failed:
+        click.echo(f"Failed to extract {image}: {error}", err=True)
+    extracted = sum(count for _, count, _ in results)
+    click.echo(f"Extracted {extracted} programs from {len(results)} disk images ({len(failed)} failed)")
+
 @disk.command()
-@click.option("--image", help='The name of the disk image file', required=True)
+@click.option("--image", "images", help='A disk image file, or a directory or zip/tar archive of disk images (can be repeated)',
+              required=True, multiple=True)
 @click.option("--swechars", help="Decode tokens as Swedish characters", default=False, is_flag=True)
-def list(image, swechars):
-    disk_viewer.show(image, swechars)
+@click.option("--format", "output_format", help="Output format; json and ndjson give one record per image",
+              type=click.Choice(["text", "json", "ndjson"]), default="text")
+@click.pass_context
+def list(ctx, images, swechars, output_format="text"):
+    from sviit import disk_viewer, archives
+    many = len(images) > 1 or any(os.path.isdir(image) or archives.is_archive(image) for image in images)
+    # Images that can't be read are reported and skipped, and make the exit status 1 at the end
+    failed = 0
+
+    if output_format == "text":
+        for i, (name, opened) in enumerate(iter_images(images)):
+            if many:
+                if i > 0:
+                    click.echo()
+                click.echo(f"=== {name} ===")
+            try:
+                with opened as d:
+                    disk_viewer.show_disk(d, swechars)
+            except Exception as e:
+                click.echo(f"Failed to read {name}: {e}", err=True)
+                failed += 1
+    else:
+        import json
+        # Records are written as soon as each image has been read, also when writing a JSON array
+        if output_format == "json":
+            click.echo("[")
+        for i, (name, opened) in enumerate(iter_images(images)):
+            try:
+                with opened as d:
+                    record = dict(image=name, **disk_viewer.inventory(d, swechars))
+            except Exception as e:
+                record = {"image": name, "error": str(e)}
+                failed += 1
+            if output_format == "json":
+                click.echo(("," if i > 0 else "") + json.dumps(record))
+            else:
+                click.echo(json.dumps(record))
+        if output_format == "json":
+            click.echo("]")
+
+    if failed:
+        ctx.exit(1)
 
 @disk.command()
 @click.option("--image", help='The name of the disk image file', required=True)
@@ -32,20 +139,305 @@ def list(image, swechars):
 @click.option("--tracks", help='The track ids to view')
 @click.option("--swechars", help="Decode tokens as Swedish characters", default=False, is_flag=True)
 def view(image, file=None, tracks=None, swechars=False):
-    disk = Disk(image)
-    if file:
+    from sviit import basic_tokenizer
+    with open_disk(image) as disk:
+        if file:
+            try:
+                f = disk.get_file(file, swechars)
+            except Exception as e:
+                logging.exception(e)
+                click.echo(f"Failed to load {file} from disk image")
+                raise click.Abort()
+            data = f.read()
+        else:
+            data = b"".join(disk.tracks[track_num] for track_num in map(int, tracks.split(',')))
+
+    for _, line in basic_tokenizer.iter_detokenize(data, swechars):
+        print(line)
+
+@disk.command()
+@click.argument("image")
+@click.argument("other", required=False)
+@click.option("--store", "store_path", help='Rank the images in this track store by how many tracks they share with IMAGE')
+@click.option("--limit", help="The number of images to rank", type=int, default=20)
+@click.option("--context", help="Lines of context in program diffs", type=int, default=3)
+@click.option("--swechars", help="Decode tokens as Swedish characters", default=False, is_flag=True)
+def diff(image, other=None, store_path=None, limit=20, context=3, swechars=False):
+    """Compare two disk images, or find the images in a track store most like IMAGE"""
+    from sviit import disk_diff
+    if store_path:
+        from sviit.track_store import TrackStore
+        with open_disk(image) as a, TrackStore(store_path) as track_store:
+            hashes = disk_diff.data_track_hashes(a)
+            for name, shared in track_store.rank_by_shared_tracks(hashes, limit):
+                click.echo(f"{shared:3d}/{len(hashes)}  {name}")
+        return
+    if not other:
+        click.echo("Give another image to compare with, or --store")
+        raise click.Abort()
+
+    with open_disk(image) as a, open_disk(other) as b:
+        identical = True
+        tracks = disk_diff.diff_tracks(a, b)
+        if tracks:
+            identical = False
+            click.echo("Tracks:")
+            for trk, sectors in tracks:
+                click.echo(f"  Track {trk}: sectors {', '.join(map(str, sectors))} differ")
+
+        only_a, only_b, changed = disk_diff.diff_directory(a, b)
+        fat = disk_diff.diff_fat(a, b)
+        if only_a or only_b or changed or fat:
+            identical = False
+            click.echo("Directory:")
+            for f in only_a:
+                click.echo(f"  Only in {image}: {f.displayname.rstrip()} Tracks: {f.tracks.tolist()}")
+            for f in only_b:
+                click.echo(f"  Only in {other}: {f.displayname.rstrip()} Tracks: {f.tracks.tolist()}")
+            for fa, fb in changed:
+                click.echo(f"  {fa.displayname.rstrip()}: type {fa.type:#04x} -> {fb.type:#04x}, size {fa.size} -> {fb.size}, "
+                           f"tracks {fa.tracks.tolist()} -> {fb.tracks.tolist()}")
+            if fat:
+                click.echo(f"  FAT entries differ for tracks {', '.join(map(str, fat))}")
+
+        for filename, lines in disk_diff.diff_programs(a, b, swechars, context):
+            identical = False
+            for line in lines:
+                click.echo(line)
+
+        if identical:
+            click.echo("The images are identical")
+
+@main.group()
+def store():
+    pass
+
+@store.command()
+@click.option("--store", "path", help='The directory of the track store', required=True)
+@click.argument("images", nargs=-1, required=True)
+def add(path, images):
+    """Add disk images, or directories or zip/tar archives of disk images, to a track store"""
+    from sviit.images import iter_sources
+    from sviit.track_store import TrackStore
+    with TrackStore(path) as track_store:
+        for image in images:
+            for name, source in iter_sources(image):
+                try:
+                    with open_disk(source) as disk:
+                        track_store.add_image(name, disk)
+                except Exception as e:
+                    click.echo(f"Failed to add {source if isinstance(source, str) else name}: {e}", err=True)
+        images, tracks, size = track_store.get_stats()
+        click.echo(f"{images} disk images, {tracks} unique tracks, {size} bytes")
+
+@store.command()
+@click.option("--store", "path", help='The directory of the track store', required=True)
+@click.option("--name", help='The name of the disk image in the store', required=True)
+@click.option("--output", help='The disk image file to write', required=True)
+def export(path, name, output):
+    """Write a disk image from a track store to a file"""
+    from sviit.track_store import TrackStore
+    with TrackStore(path) as track_store:
         try:
-            f = disk.get_file(file, swechars)
-        except Exception as e:
-            logging.exception(e)
-            click.echo(f"Failed to load {file} from disk image")
+            disk = track_store.load_image(name)
+        except KeyError:
+            click.echo(f"No disk image named {name} in the store")
             raise click.Abort()
-        data = f.read()
+        disk.save_to_file(output)
+
+@store.command(name="list")
+@click.option("--store", "path", help='The directory of the track store', required=True)
+def list_images(path):
+    """List the disk images in a track store, with their duplicates"""
+    from sviit.track_store import TrackStore
+    with TrackStore(path) as track_store:
+        for name in track_store.get_names():
+            duplicates = track_store.find_duplicates(name)
+            click.echo(name + (f"  (same as {', '.join(duplicates)})" if duplicates else ""))
+
+@main.group()
+def index():
+    pass
+
+@index.command()
+@click.option("--input", "inpath", help='The directory to search for disk images', required=True)
+@click.option("--index", "index_file", help='The index file to create', required=True)
+@click.option("--workers", help="Number of worker processes (default is the number of CPUs)", type=int, default=None)
+@click.option("--swechars", help="Decode tokens as Swedish characters", default=False, is_flag=True)
+def build(inpath, index_file, workers=None, swechars=False):
+    """Index the BASIC programs in all disk images in a directory"""
+    from sviit import program_index
+    num_programs, num_lines, failed = program_index.build(inpath, index_file, workers, swechars)
+    for image, error in failed:
+        click.echo(f"Failed to index {image}: {error}", err=True)
+    click.echo(f"Indexed {num_lines} lines in {num_programs} programs")
+
+@index.command()
+@click.option("--index", "index_file", help='The index file to search', required=True)
+@click.option("--limit", help="The maximum number of lines to show", type=int, default=None)
+@click.argument("text")
+def query(index_file, text, limit=None):
+    """Find lines containing a sequence of tokens, e.g. "POKE &HF3*" (a trailing * matches any ending)"""
+    from sviit import program_index
+    for image, filename, line_number, line in program_index.query(index_file, text, limit):
+        click.echo(f"{image}  {filename}  {line}")
+
+@main.group()
+def catalog():
+    pass
+
+@catalog.command("build")
+@click.option("--input", "inpath", help='The directory or zip/tar archive to search for disk images', required=True)
+@click.option("--catalog", "catalog_file", help='The catalog file to create', required=True)
+@click.option("--workers", help="Number of worker processes (default is the number of CPUs)", type=int, default=None)
+def build_catalog(inpath, catalog_file, workers=None):
+    """Catalog the directory entries of all disk images in a directory or archive"""
+    from sviit import catalog
+    num_images, num_entries, failed = catalog.build(inpath, catalog_file, workers)
+    for image, error in failed:
+        click.echo(f"Failed to catalog {image}: {error}", err=True)
+    click.echo(f"Cataloged {num_entries} directory entries in {num_images} disk images")
+
+@catalog.command()
+@click.option("--catalog", "catalog_file", help='The catalog file to search', required=True)
+@click.option("--basic", help="Only BASIC programs", default=False, is_flag=True)
+@click.option("--deleted", help="Include deleted files", default=False, is_flag=True)
+@click.argument("pattern", required=False)
+def find(catalog_file, pattern=None, basic=False, deleted=False):
+    """List the files whose name matches PATTERN (e.g. "GAME*"), or all files"""
+    from sviit import catalog
+    with catalog.Catalog(catalog_file) as c:
+        for image, filename, file_type, size, _, tracks in c.query(pattern, basic, deleted):
+            click.echo(f"{image}  {filename:9} {file_type:#04x} {size:6d}  Tracks: {tracks}")
+
+@main.command()
+@click.option("--input", "inpath", help='The directory to search for disk images', required=True)
+@click.option("--threshold", help="How similar programs must be to be in the same family (0-1)", type=float, default=0.7)
+@click.option("--workers", help="Number of worker processes (default is the number of CPUs)", type=int, default=None)
+def similar(inpath, threshold=0.7, workers=None):
+    """Report families of near-identical BASIC programs across disk images"""
+    from sviit import program_similarity
+    families = program_similarity.find_families(inpath, threshold, workers)
+    for i, family in enumerate(families):
+        click.echo(f"Family {i + 1}: {len(family)} programs")
+        for image, filename, similarity in family:
+            click.echo(f"  {similarity:4.2f}  {image}  {filename}")
+
+@main.command()
+@click.option("--input", "inpath", help='The directory to search for disk images', required=True)
+@click.option("--output", "outpath", help='The directory to write the recovered programs and the report to', required=True)
+@click.option("--workers", help="Number of worker processes (default is the number of CPUs)", type=int, default=None)
+@click.option("--swechars", help="Decode tokens as Swedish characters", default=False, is_flag=True)
+def recover(inpath, outpath, workers=None, swechars=False):
+    """Recover BASIC programs from deleted files and orphan tracks in all disk images in a directory"""
+    from sviit import recovery
+    report, failed = recovery.recover_all(inpath, outpath, workers, swechars)
+    for image, error in failed:
+        click.echo(f"Failed to recover {image}: {error}", err=True)
+    recovered = [entry for entry in report if entry["output"] is not None]
+    complete = sum(1 for entry in recovered if entry["complete"])
+    click.echo(f"Recovered {len(recovered)} programs ({complete} complete) out of {len(report)} deleted files and orphan tracks")
+
+@main.command()
+@click.option("--input", "inpath", help='A disk image, or a directory or zip/tar archive of disk images', required=True)
+@click.option("--output", "outpath", help='The directory to write repaired copies of damaged images to')
+@click.option("--report", "report_file", help='JSON file to write the summary and the problems of each damaged image to')
+@click.option("--workers", help="Number of worker processes (default is the number of CPUs)", type=int, default=None)
+def fsck(inpath, outpath=None, report_file=None, workers=None):
+    """Check the directory and FAT of disk images for broken chains, and optionally repair them"""
+    from sviit import fsck
+    if outpath is not None and os.path.realpath(outpath) == os.path.realpath(inpath):
+        raise click.BadParameter("Repaired images can't replace the originals", param_hint="--output")
+    results = []
+    for image, report, error in fsck.fsck_all(inpath, outpath, workers):
+        results.append((image, report, error))
+        if error is not None:
+            click.echo(f"Failed to check {image}: {error}", err=True)
+        elif fsck.is_damaged(report):
+            problems = [p["problem"] for p in report["problems"]]
+            if report["fat_mismatches"]:
+                problems.insert(0, f"{report['fat_mismatches']} FAT mismatches")
+            click.echo(f"{image}: {', '.join(problems)}")
+    summary = fsck.summarize(results)
+    if report_file:
+        fsck.write_report(summary, report_file)
+    click.echo(f"Checked {summary['images']} images: {summary['clean']} clean, {summary['damaged']} damaged, "
+               f"{summary['no_fat']} without a FAT, {len(summary['failed'])} failed")
+    for problem, n in sorted(summary["problems"].items()):
+        click.echo(f"  {n:6d} {problem}")
+    if outpath is not None:
+        click.echo(f"Repaired {summary['repaired']} images")
+
+@main.command()
+@click.option("--output", help='JSON file to save the results to')
+@click.option("--compare", "baseline", help='JSON file with earlier results to compare with')
+@click.option("--rounds", help="Number of times to time each benchmark", type=int, default=5)
+@click.option("--seed", help="Seed for the synthetic disk images", type=int, default=0)
+@click.option("--only", help="Only run the benchmarks starting with this name (can be repeated)", multiple=True)
+def bench(output=None, baseline=None, rounds=5, seed=0, only=()):
+    """Time the hot paths on synthetic disk images"""
+    from sviit import benchmark
+    results = benchmark.run(rounds, seed, only)
+    if output:
+        benchmark.save_results(results, output)
+    if baseline:
+        for name, old, new in benchmark.compare(benchmark.load_results(baseline), results):
+            if old is None or new is None:
+                click.echo(f"{name:20} {'-' if old is None else f'{old * 1e3:10.3f} ms':>13} "
+                           f"{'-' if new is None else f'{new * 1e3:10.3f} ms':>13}")
+            else:
+                click.echo(f"{name:20} {old * 1e3:10.3f} ms {new * 1e3:10.3f} ms {old / new:6.2f}x")
     else:
-        data = bytes()
-        for track_num in map(int, tracks.split(',')):
-            data += disk.tracks[track_num]
+        for name, result in results["benchmarks"].items():
+            click.echo(f"{name:20} {result['best'] * 1e3:10.3f} ms")
 
-    lines = basic_tokenizer.detokenize(data, swechars)
-    for line in lines:
-        print(line)
+@main.command()
+@click.option("--cache-size", help="The number of disk images to keep open between commands", type=int, default=32)
+def batch(cache_size=32):
+    """Run sviit commands read from stdin, one per line, e.g. disk view --image X --file Y"""
+    import shlex
+    from sviit.images import DiskCache
+    global _disk_cache
+    _disk_cache = DiskCache(cache_size)
+    failed = 0
+    try:
+        for line in sys.stdin:
+            args = shlex.split(line, comments=True)
+            if not args:
+                continue
+            if args[0] == "batch":
+                click.echo("Can't run batch from batch", err=True)
+                failed += 1
+                continue
+            try:
+                # Commands that exit with a status return it instead of exiting in this mode
+                if main.main(args, prog_name="sviit", standalone_mode=False):
+                    failed += 1
+            except click.ClickException as e:
+                e.show()
+                failed += 1
+            except click.Abort:
+                click.echo("Aborted!", err=True)
+                failed += 1
+            except Exception as e:
+                logging.exception(e)
+                failed += 1
+            sys.stdout.flush()
+    finally:
+        _disk_cache.close()
+        _disk_cache = None
+    if failed:
+        click.echo(f"{failed} commands failed", err=True)
+        click.get_current_context().exit(1)
+
+@main.command()
+@click.option("--root", help='The directory of disk images to serve', required=True)
+@click.option("--host", help="The address to listen on", default="127.0.0.1")
+@click.option("--port", help="The port to listen on", type=int, default=8328)
+@click.option("--cache-size", help="The number of disk images to keep open", type=int, default=64)
+@click.option("--workers", help="Number of worker processes for detokenizing (default is the number of CPUs)", type=int, default=None)
+def serve(root, host="127.0.0.1", port=8328, cache_size=64, workers=None):
+    """Serve image listings, files and detokenized programs over HTTP as JSON"""
+    from sviit import server
+    click.echo(f"Serving {root} on http://{host}:{port}/")
+    server.serve(root, host, port, cache_size, workers)
@@ -1,7 +1,13 @@
-from sviit.util import str_from_swechar
+from sviit.util import str_from_swechar, import_numpy
 import sys
+import io
+import hashlib
+import contextlib
+import os
+import mmap
 import logging
-from typing import List, Tuple, Optional, Union
+from array import array
+from typing import BinaryIO, Dict, Iterator, List, Set, Tuple, Optional, Union
 
 ENCODING = "cp1252"
 
@@ -10,29 +16,75 @@ SIZE_TRACK_X = 17*256
 SIZE_SS = SIZE_TRACK_0 + 39 * SIZE_TRACK_X
 SIZE_DS = SIZE_TRACK_0 + 79 * SIZE_TRACK_X
 
+FAT_FREE = 0xFF
+FAT_RESERVED = 0xFE
+DIRECTORY_END = 0xFF
+# Tracks that never hold file data: the boot tracks and the directory, reserved in the FAT
+SYSTEM_TRACKS = (0, 1, 2, 20)
+
+
+def track_offset(track_no: int, double_sided: bool) -> int:
+    # Position of a track in the image file. Double sided images interleave the two sides,
+    # with side 1 (tracks 40-79) before side 0 on each cylinder except the first.
+    if track_no == 0:
+        return 0
+    if not double_sided:
+        return SIZE_TRACK_0 + (track_no - 1) * SIZE_TRACK_X
+    if track_no < 40:
+        return SIZE_TRACK_0 + (track_no * 2 - 1) * SIZE_TRACK_X
+    return SIZE_TRACK_0 + (track_no - 40) * 2 * SIZE_TRACK_X
+
+def track_size(track_no: int) -> int:
+    return SIZE_TRACK_0 if track_no == 0 else SIZE_TRACK_X
+
+def majority_fat(copies) -> Tuple[bytes, List[int]]:
+    # Picks the most common value of each byte of the three FAT copies, or the value in the first copy
+    # where all three differ. Also returns the positions where the copies don't agree.
+    a, b, c = (bytes(copy) for copy in copies)
+    if a == b == c:
+        return a, []
+    fat = bytearray(a)
+    mismatches = []
+    for i, (x, y, z) in enumerate(zip(a, b, c)):
+        if x != y or x != z:
+            mismatches.append(i)
+            if x != y and y == z:
+                fat[i] = y
+    return bytes(fat), mismatches
+
+def fat_copies(dir_track) -> List[bytes]:
+    return [bytes(dir_track[14*256:15*256]), bytes(dir_track[15*256:16*256]), bytes(dir_track[16*256:17*256])]
+
+def is_formatted_fat(fat) -> bool:
+    # A formatted disk has the system tracks reserved in the FAT
+    return all(fat[trk] == FAT_RESERVED for trk in SYSTEM_TRACKS)
+
 
 class FileNotFoundException(Exception):
     pass
 
 class File:
+    # Disks can have a lot of files, so only the directory entry is stored; displayname and attr are
+    # computed when used, and the chain of tracks is an array of bytes
+    __slots__ = ("disk", "name", "type", "size", "deleted", "tracks", "index_position")
+
     def __init__(self, disk, filename: str, type: int, size: int, deleted: bool, tracks, index_position):
         self.disk = disk
-        self.filename = filename.strip()
+        # As in the directory entry, padded with spaces
+        self.name = filename
         self.type = type
         self.size = size
         self.deleted = deleted
-        self.tracks = tracks
+        self.tracks = tracks if isinstance(tracks, array) else array('B', tracks)
         self.index_position = index_position
 
-        pattr = " "
-        rattr = " "
-        if type & 0x10:
-            pattr = "P"
-            type -= 0x10
-        if type & 0x40:
-            rattr = "R"
-            type -= 0x40
-        delim = ' '
+    @property
+    def filename(self) -> str:
+        return self.name.strip()
+
+    @property
+    def displayname(self) -> str:
+        type = self.type & ~0x50
         if type == 0x00:
             delim = ' '
         elif type == 0x01:
@@ -43,28 +95,256 @@ class File:
             delim = '#'
         else:
             delim = '?'
-        self.displayname = "%s%s%s" % (filename[0:6], delim, filename[6:9])
-        self.attr = "%c%c" % (pattr, rattr)
+        return "%s%s%s" % (self.name[0:6], delim, self.name[6:9])
+
+    @property
+    def attr(self) -> str:
+        return "%c%c" % ("P" if self.type & 0x10 else " ", "R" if self.type & 0x40 else " ")
 
     def is_basic_file(self):
         return (self.type & 0xA1) == 0x80
 
-    def read(self):
-        data = bytes()
+    def read(self) -> bytes:
+        return b"".join(self.iter_chunks())
+
+    def open(self) -> io.BufferedReader:
+        return io.BufferedReader(FileReader(self))
+
+    def iter_chunks(self) -> Iterator[memoryview]:
+        # Yields the file contents one track at a time, without copying the track data.
+        # The last chunk is trimmed to the file size; files of unknown size (circular chains) yield whole tracks.
+        remaining = self.size
         for trk in self.tracks:
             if trk < 0 or trk >= len(self.disk.tracks):
                 logging.warning('File %s is stored on track %d which doesn''t exist' % (self.displayname, trk))
                 break
-            data += self.disk.tracks[trk]
+            chunk = memoryview(self.disk.tracks[trk])
+            if remaining >= 0:
+                if remaining <= len(chunk):
+                    yield chunk[:remaining]
+                    break
+                remaining -= len(chunk)
+            yield chunk
 
-        return data[:self.size]
 
+class FileReader(io.RawIOBase):
+    # A read-only file object over the contents of a File
+    def __init__(self, file: File):
+        self._chunks = file.iter_chunks()
+        self._current = memoryview(b"")
 
-class Disk:
-    tracks: List[bytes]
+    def readable(self):
+        return True
 
-    def __init__(self, filename: str):
-        self.tracks = self.load_from_file(filename)
+    def readinto(self, buffer) -> int:
+        while not self._current:
+            self._current = next(self._chunks, None)
+            if self._current is None:
+                self._current = memoryview(b"")
+                return 0
+        n = min(len(buffer), len(self._current))
+        buffer[:n] = self._current[:n]
+        self._current = self._current[n:]
+        return n
+
+
+class DirectoryIndex:
+    # The parsed directory and FAT of a disk. Built once from track 20 and reused until track 20 changes.
+    def __init__(self, dir_track, files: List[File]):
+        self.dir_track = dir_track
+        self.files = files
+        self.existing = [f for f in files if not f.deleted]
+        self.deleted = [f for f in files if f.deleted]
+
+        self.by_name: Dict[str, File] = {}
+        for f in self.existing:
+            self.by_name.setdefault(f.filename, f)
+
+        self.track_owners: Dict[int, List[File]] = {}
+        for f in files:
+            for trk in f.tracks:
+                self.track_owners.setdefault(trk, []).append(f)
+
+
+class DiskTransaction:
+    # A batch of changes to a disk, see Disk.edit. Directory and FAT changes are made on a private copy,
+    # and tracks are copied on first write, so nothing is visible on the disk until the transaction is committed.
+    def __init__(self, disk: "Disk"):
+        self.disk = disk
+        directory, dat, fat = disk._get_directory()
+        self.directory = bytearray(directory)
+        self.dat = bytearray(dat)
+        self.fat = bytearray(fat)
+        self.tracks: Dict[int, bytearray] = {}
+        self.directory_changed = False
+
+    def write_track(self, track_no: int, data: bytes, offset: int=0):
+        track = self.tracks.get(track_no)
+        if track is None:
+            track = self.tracks[track_no] = bytearray(self.disk.tracks[track_no])
+        if offset < 0 or offset + len(data) > len(track):
+            raise Exception('Data doesn''t fit in track %d' % track_no)
+        track[offset:offset+len(data)] = data
+
+    def find_entry(self, filename: str, swechars=False) -> int:
+        # The directory index of an existing file
+        filename = self.disk.normalize_filename(filename, swechars)
+        for index_no in range(0, 13*16):
+            entry = self.directory[index_no*16:index_no*16+16]
+            if entry[0] == DIRECTORY_END:
+                break
+            if entry[0] != 0 and bytes(entry[0:9]).decode(ENCODING).strip() == filename:
+                return index_no
+        raise FileNotFoundException(f"Failed to get file {filename}")
+
+    def create_file_from_tracks(self, filename: str, file_type: int, tracks: List[int]):
+        index_no = 0
+        while self.directory[index_no * 16] != DIRECTORY_END:
+            index_no += 1
+            if index_no == 13*16:
+                raise Exception('Directory is full')
+
+        file_entry = ('%-9s' % filename).encode(ENCODING)[:9] + bytes([file_type, tracks[0]]) + b"\xFF" * 5
+        self.directory[index_no*16:index_no*16+16] = file_entry
+        if index_no + 1 < 13*16:
+            self.directory[index_no*16+16] = DIRECTORY_END
+
+        current = tracks[0]
+        for next in tracks[1:]:
+            self.fat[current] = next
+            current = next
+        self.fat[current] = 0xC0 + 17
+        self.directory_changed = True
+
+    def create_file(self, filename: str, file_type: int, data: bytes, swechars=False):
+        # Stores the data on the first free tracks and adds a directory entry for it
+        filename = self.disk.normalize_filename(filename, swechars)
+        num_tracks = max(1, (len(data) + SIZE_TRACK_X - 1) // SIZE_TRACK_X)
+        free = [trk for trk in range(0, self.disk.no_tracks()) if self.fat[trk] == FAT_FREE]
+        if len(free) < num_tracks:
+            raise Exception('Disk is full')
+        tracks = free[:num_tracks]
+        for i, trk in enumerate(tracks):
+            self.write_track(trk, data[i*SIZE_TRACK_X:(i+1)*SIZE_TRACK_X])
+        self.create_file_from_tracks(filename, file_type, tracks)
+        last_size = len(data) - (num_tracks - 1) * SIZE_TRACK_X
+        self.fat[tracks[-1]] = 0xC0 + (last_size + 255) // 256
+
+    def delete_file(self, filename: str, swechars=False):
+        # Like the SVI, marks the entry as deleted and frees its tracks but leaves the data
+        index_no = self.find_entry(filename, swechars)
+        self.directory[index_no*16] = 0
+        fat_ptr = self.directory[index_no*16+10]
+        visited = set()
+        while fat_ptr < 0xC0 and fat_ptr not in visited:
+            visited.add(fat_ptr)
+            next_ptr = self.fat[fat_ptr]
+            self.fat[fat_ptr] = FAT_FREE
+            fat_ptr = next_ptr
+        self.directory_changed = True
+
+    def rename_file(self, filename: str, new_filename: str, swechars=False):
+        index_no = self.find_entry(filename, swechars)
+        new_filename = self.disk.normalize_filename(new_filename, swechars)
+        self.directory[index_no*16:index_no*16+9] = ('%-9s' % new_filename).encode(ENCODING)[:9]
+        self.directory_changed = True
+
+    def commit(self):
+        for track_no, track in self.tracks.items():
+            self.disk.tracks[track_no] = track
+            self.disk._dirty_tracks.add(track_no)
+        if self.directory_changed:
+            self.disk._write_directory(bytes(self.directory), bytes(self.dat), bytes(self.fat))
+        self.disk._invalidate_caches()
+        self.tracks = {}
+        self.directory_changed = False
+
+
+class Disk:
+    tracks: List[Union[bytes, bytearray, memoryview]]
+
+    def __init__(self, filename: str, use_mmap: bool=False):
+        # With use_mmap, the tracks are read-only memoryviews into one shared mapping of the image file.
+        # Writing a track replaces the entry in the track list, so the image file itself is never modified.
+        self._mmap = None
+        if use_mmap:
+            tracks = self.load_from_mmap(filename)
+        else:
+            tracks = self.load_from_file(filename)
+        self._init_tracks(tracks, filename)
+
+    @classmethod
+    def from_tracks(cls, tracks: List[Union[bytes, bytearray, memoryview]]) -> "Disk":
+        # A disk from tracks kept elsewhere (in track order, not file order)
+        if len(tracks) != 40 and len(tracks) != 80:
+            raise Exception('Invalid number of tracks: %d' % len(tracks))
+        for trk, track in enumerate(tracks):
+            if len(track) != track_size(trk):
+                raise Exception('Invalid size of track %d: %d bytes' % (trk, len(track)))
+        disk = cls.__new__(cls)
+        disk._mmap = None
+        disk._init_tracks(list(tracks), None)
+        return disk
+
+    @classmethod
+    def from_bytes(cls, data: Union[bytes, bytearray, memoryview]) -> "Disk":
+        # A disk from the contents of an image file. The tracks are views into data, which isn't copied.
+        disk = cls.__new__(cls)
+        disk._mmap = None
+        disk._init_tracks(disk._split_tracks(memoryview(data)), None)
+        return disk
+
+    @classmethod
+    def from_file(cls, f: BinaryIO) -> "Disk":
+        # A disk from a binary file object, e.g. a member of an archive
+        data = f.read(SIZE_DS + 1)
+        return cls.from_bytes(data)
+
+    def _init_tracks(self, tracks: List[Union[bytes, bytearray, memoryview]], filename: Optional[str]):
+        self.tracks = tracks
+        self._index: Optional[DirectoryIndex] = None
+        self._track_usage: Optional[List[int]] = None
+        self._track_usage_tracks: List[Union[bytes, memoryview]] = []
+        # The file the tracks were last loaded from or saved to, and the tracks changed since then
+        self._saved_filename = filename
+        self._saved_tracks = list(self.tracks)
+        self._dirty_tracks: Set[int] = set()
+
+    @contextlib.contextmanager
+    def edit(self) -> Iterator[DiskTransaction]:
+        # All changes made in the with block are committed together at the end, or discarded on an exception
+        tx = DiskTransaction(self)
+        yield tx
+        tx.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._mmap is None:
+            return
+        self._index = None
+        self._track_usage = None
+        # Views of the mapping are also kept as the tracks last saved and the tracks the usage was computed for
+        for tracks in (self.tracks, self._saved_tracks, self._track_usage_tracks):
+            for track in tracks:
+                if isinstance(track, memoryview):
+                    try:
+                        track.release()
+                    except BufferError:
+                        pass
+        self._saved_tracks = []
+        self._track_usage_tracks = []
+        try:
+            self._mmap_view.release()
+            self._mmap.close()
+        except BufferError:
+            # Something still uses the mapping, e.g. an open File reader; it's closed when that is gone
+            pass
+        self._mmap = self._mmap_view = None
 
     def is_single_sided(self):
         return len(self.tracks) == 40
@@ -76,23 +356,36 @@ class Disk:
         return len(self.tracks)
 
     def has_fat(self):
-        dir_track = self.tracks[20]
-        fats = [dir_track[14*256:15*256], dir_track[15*256:16*256], dir_track[16*256:17*256]]
-
-        for fat in fats:
-            if fat[0] != 254 or fat[1] != 254 or fat[2] != 254 or fat[20] != 254:
-                return False
-
-        return True
+        # Judged on the majority of the three FAT copies, which is also what the files are read with
+        fat, _ = majority_fat(fat_copies(self.tracks[20]))
+        return is_formatted_fat(fat)
 
     def track_contains_data(self, track_no: int):
         # Returns 0 if no data (just one value)
         # Returns -1 if probably no data (at most 4 different values)
         # Returns 1 if data
-        cnt=[0] * 256
-        for byte in self.tracks[track_no]:
-            cnt[byte] += 1
-        dif = len([x for x in cnt if x > 0])
+        return self.get_track_usage()[track_no]
+
+    def get_track_usage(self) -> List[int]:
+        # track_contains_data for all tracks, computed once for as long as the tracks aren't replaced
+        if self._track_usage is None or len(self._track_usage_tracks) != len(self.tracks) or \
+                any(a is not b for a, b in zip(self._track_usage_tracks, self.tracks)):
+            self._track_usage = [self._classify_track(dif) for dif in self._count_distinct_values()]
+            self._track_usage_tracks = list(self.tracks)
+        return self._track_usage
+
+    def _count_distinct_values(self) -> List[int]:
+        # The number of distinct byte values in each track
+        numpy = import_numpy()
+        if numpy is None:
+            return [len(set(track)) for track in self.tracks]
+        rest = numpy.frombuffer(b"".join(self.tracks[1:]), dtype=numpy.uint8).reshape(-1, SIZE_TRACK_X)
+        # Histogram of all tracks in one go, by giving each track its own range of 256 bins
+        offsets = numpy.arange(len(rest), dtype=numpy.intp)[:, None] * 256
+        hist = numpy.bincount((rest + offsets).ravel(), minlength=len(rest) * 256).reshape(-1, 256)
+        return [len(set(self.tracks[0]))] + numpy.count_nonzero(hist, axis=1).tolist()
+
+    def _classify_track(self, dif: int) -> int:
         if dif == 1:
             return 0
         if dif <= 4:
@@ -103,31 +396,71 @@ class Disk:
         with open(filename, "rb") as f:
             data: bytes = f.read(1000000)
 
-        tracks = [data[:SIZE_TRACK_0]]
+        return self._split_tracks(data)
+
+    def load_from_mmap(self, filename: str) -> List[memoryview]:
+        with open(filename, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size != SIZE_SS and size != SIZE_DS:
+                raise Exception('Invalid image size: %d bytes' % size)
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._mmap_view = memoryview(self._mmap)
+
+        return self._split_tracks(self._mmap_view)
+
+    def _split_tracks(self, data: Union[bytes, memoryview]) -> List[Union[bytes, memoryview]]:
+        # Slicing a memoryview doesn't copy, so an mmap:ed image is never copied here
         if len(data) == SIZE_SS:
-            for trk in range(0,39):
-                tracks.append(data[SIZE_TRACK_0 + trk * SIZE_TRACK_X:SIZE_TRACK_0 + (trk + 1) * SIZE_TRACK_X])
+            double_sided = False
         elif len(data) == SIZE_DS:
-            for trk in range(0,39):
-                start = SIZE_TRACK_0 + (trk * 2 + 1) * SIZE_TRACK_X
-                tracks.append(data[start:start + SIZE_TRACK_X])
-            for trk in range(0,40):
-                start = SIZE_TRACK_0 + trk * 2 * SIZE_TRACK_X
-                tracks.append(data[start:start + SIZE_TRACK_X])
+            double_sided = True
         else:
             raise Exception('Invalid image size: %d bytes' % len(data))
 
+        tracks = []
+        for trk in range(0, 80 if double_sided else 40):
+            start = track_offset(trk, double_sided)
+            tracks.append(data[start:start + track_size(trk)])
         return tracks
 
+    def get_dirty_tracks(self) -> Set[int]:
+        # Tracks changed since the image was loaded or saved, either through edit() or by replacing the track
+        dirty = set(self._dirty_tracks)
+        dirty.update(trk for trk, (a, b) in enumerate(zip(self.tracks, self._saved_tracks)) if a is not b)
+        return dirty
+
+    def _is_saved_file(self, filename: str) -> bool:
+        # Whether filename is the file the tracks were loaded from or last saved to, still in one piece
+        if self._saved_filename is None:
+            return False
+        try:
+            return os.path.samefile(filename, self._saved_filename) and \
+                os.path.getsize(filename) == (SIZE_DS if self.is_double_sided() else SIZE_SS)
+        except OSError:
+            # One of them doesn't exist (any more)
+            return False
+
     def save_to_file(self, filename: str):
-        with open(filename, "wb") as f:
-            f.write(bytearray(self.tracks[0]))
-            if self.is_double_sided():
-                f.write(bytearray(self.tracks[40]))
-            for trk in range(1,40):
-                f.write(bytearray(self.tracks[trk]))
-                if self.is_double_sided():
-                    f.write(bytearray(self.tracks[40 + trk]))
+        # Saving back to the file the image came from only writes the changed tracks
+        if self._is_saved_file(filename):
+            with open(filename, "r+b") as f:
+                for trk in sorted(self.get_dirty_tracks()):
+                    f.seek(track_offset(trk, self.is_double_sided()))
+                    f.write(self.tracks[trk])
+        else:
+            with open(filename, "wb") as f:
+                for trk in sorted(range(0, self.no_tracks()), key=lambda trk: track_offset(trk, self.is_double_sided())):
+                    f.write(self.tracks[trk])
+        self._saved_filename = filename
+        self._saved_tracks = list(self.tracks)
+        self._dirty_tracks.clear()
+
+    def content_hash(self) -> str:
+        # Hash of the track data in track order (which isn't the file order for double sided images)
+        h = hashlib.sha1()
+        for track in self.tracks:
+            h.update(track)
+        return h.hexdigest()
 
     def get_disk_attributes(self) -> str:
         dir_track = self.tracks[20]
@@ -143,64 +476,65 @@ class Disk:
         return 'Unknown (%d)' % dat[0]
 
     def get_ipl_command(self) -> str:
-        dir_track = self.tracks[20]
+        dir_track = bytes(self.tracks[20])
         dat = dir_track[13*256:14*256]
         ipl_command: bytes = dat[1:].split(b"\0", 1)[0]
         return ipl_command.decode(ENCODING)
 
     def get_files(self) -> List[File]:
-        return [f for f in self.get_all_files() if not f.deleted]
+        return list(self._get_index().existing)
 
     def get_deleted_files(self) -> List[File]:
-        return [f for f in self.get_all_files() if f.deleted]
+        return list(self._get_index().deleted)
 
-    def _get_directory(self) -> Tuple[bytes, bytes, bytes]:
+    def get_track_owners(self, track_no: int) -> List[File]:
+        # All files, existing and deleted, whose FAT chain goes through the given track
+        return list(self._get_index().track_owners.get(track_no, []))
+
+    def _get_index(self) -> DirectoryIndex:
+        # Track 20 is only modified in place by edit(), which drops the index, so a new object there
+        # means the directory has changed
         dir_track = self.tracks[20]
+        if self._index is None or self._index.dir_track is not dir_track:
+            self._index = DirectoryIndex(dir_track, self._parse_all_files())
+        return self._index
+
+    def _invalidate_caches(self):
+        # Needed after tracks have been modified in place
+        self._index = None
+        self._track_usage = None
+
+    def _get_directory(self) -> Tuple[bytes, bytes, bytes]:
+        dir_track = bytes(self.tracks[20])
         directory = dir_track[0:13*256]
         dat = dir_track[13*256:14*256]
-        fat = [dir_track[14*256:15*256], dir_track[15*256:16*256], dir_track[16*256:17*256]]
 
-        if fat[0][0:256] != fat[1][0:256] or fat[0][0:256] != fat[2][0:256]:
-            logging.warning('FAT mismatches')
+        fat, mismatches = majority_fat(fat_copies(dir_track))
+        if mismatches:
+            logging.warning('FAT mismatches in %d entries, using the most common values' % len(mismatches))
 
-        fat = fat[0] # TODO: Pick most common
-
-        if fat[0] != 254 or fat[1] != 254 or fat[2] != 254 or fat[20] != 254:
+        if not is_formatted_fat(fat):
             logging.warning('FAT not formatted properly')
 
         return directory, dat, fat
 
     def _write_directory(self, directory: bytes=None, dat: bytes=None, fat: bytes=None):
-        dir_track = self.tracks[20]
+        dir_track = bytes(self.tracks[20])
 
         if not directory:
             directory = dir_track[0:13*256]
         if not dat:
             dat = dir_track[13*256:14*256]
         if not fat:
-            fat = dir_track[14*256:15*256]
+            fat, _ = majority_fat(fat_copies(dir_track))
 
-        self.tracks[20] = directory + dat + fat + fat + fat
+        self.tracks[20] = bytearray(directory + dat + fat + fat + fat)
+        self._dirty_tracks.add(20)
+        self._invalidate_caches()
 
     def create_file_from_tracks(self, filename: str, file_type: int, tracks: List[int]):
-        directory, _, fat = self._get_directory()
-
-        index_no = 0
-        while directory[index_no * 16] != 255:
-            index_no += 1
-
-        file_entry = ('%-9s%c%c\255\255\255\255\255' % (filename, chr(file_type), chr(tracks[0]))).encode(ENCODING)
-
-        directory = directory[:index_no*16] + file_entry + b"\xFF" + directory[index_no*16+17:]
-
-        mutable_fat = list(fat)
-        current = tracks[0]
-        for next in tracks[1:]:
-            mutable_fat[current] = next
-            current = next
-        mutable_fat[current] = 0xC0 + 17
-
-        self._write_directory(directory=directory, fat=bytes(mutable_fat))
+        with self.edit() as tx:
+            tx.create_file_from_tracks(filename, file_type, tracks)
 
     def normalize_filename(self, filename: str, swechars=False) -> str:
         if swechars:
@@ -216,12 +550,15 @@ class Disk:
     def get_file(self, filename: str, swechars=False) -> Optional[File]:
         filename = self.normalize_filename(filename, swechars)
 
-        for f in self.get_files():
-            if f.filename == filename:
-                return f
+        f = self._get_index().by_name.get(filename)
+        if f is not None:
+            return f
         raise FileNotFoundException(f"Failed to get file {filename}")
 
     def get_all_files(self) -> List[File]:
+        return list(self._get_index().files)
+
+    def _parse_all_files(self) -> List[File]:
         directory, _, fat = self._get_directory()
 
         files = []
@@ -243,13 +580,15 @@ class Disk:
             file_type = entry[9]
             fat_ptr = entry[10]
 
-            file_tracks: List[int] = []
+            file_tracks = array('B')
+            visited = set()
 
             circular = False
             while fat_ptr < 0xC0:
                 file_tracks.append(fat_ptr)
+                visited.add(fat_ptr)
                 fat_ptr = fat[fat_ptr]
-                if fat_ptr in file_tracks:
+                if fat_ptr in visited:
                     circular = True
                     break
 
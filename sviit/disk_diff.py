@@ -0,0 +1,84 @@
+import difflib
+from typing import Dict, List, Tuple
+
+from sviit.disk import Disk, File
+from sviit.track_store import track_hash
+from sviit import basic_tokenizer
+
+"""
+Compares two disk images, e.g. two rips of the same disk.
+
+Tracks are compared by hash first, so identical tracks are skipped without looking at their contents. For
+the tracks that differ, the changed sectors are listed. Directory entries and FAT chains are compared by
+filename, and BASIC programs that differ get a line by line diff of their listings.
+"""
+
+
+def sector_size(track_no: int) -> int:
+    return 128 if track_no == 0 else 256
+
+def changed_sectors(a, b, track_no: int) -> List[int]:
+    size = sector_size(track_no)
+    a = bytes(a)
+    b = bytes(b)
+    return [sector for sector in range(0, len(a) // size) if a[sector*size:(sector+1)*size] != b[sector*size:(sector+1)*size]]
+
+def diff_tracks(a: Disk, b: Disk) -> List[Tuple[int, List[int]]]:
+    # The tracks that differ, with the sectors that differ in each. Tracks only on one of the disks (when
+    # comparing a single sided and a double sided disk) are reported with all their sectors.
+    diffs = []
+    for trk in range(0, max(a.no_tracks(), b.no_tracks())):
+        if trk >= a.no_tracks() or trk >= b.no_tracks():
+            track = a.tracks[trk] if trk < a.no_tracks() else b.tracks[trk]
+            diffs.append((trk, list(range(0, len(track) // sector_size(trk)))))
+        elif track_hash(a.tracks[trk]) != track_hash(b.tracks[trk]):
+            diffs.append((trk, changed_sectors(a.tracks[trk], b.tracks[trk], trk)))
+    return diffs
+
+def _files_by_name(disk: Disk) -> Dict[Tuple[str, bool], File]:
+    files = {}
+    for f in disk.get_all_files():
+        files.setdefault((f.filename, f.deleted), f)
+    return files
+
+def diff_directory(a: Disk, b: Disk) -> Tuple[List[File], List[File], List[Tuple[File, File]]]:
+    # Files only on a, files only on b, and files on both whose entry or FAT chain differ
+    files_a = _files_by_name(a)
+    files_b = _files_by_name(b)
+    only_a = [f for key, f in files_a.items() if key not in files_b]
+    only_b = [f for key, f in files_b.items() if key not in files_a]
+    changed = []
+    for key, fa in files_a.items():
+        fb = files_b.get(key)
+        if fb is not None and (fa.type, fa.size, fa.tracks) != (fb.type, fb.size, fb.tracks):
+            changed.append((fa, fb))
+    return only_a, only_b, changed
+
+def diff_fat(a: Disk, b: Disk) -> List[int]:
+    # The tracks whose FAT entries differ
+    _, _, fat_a = a._get_directory()
+    _, _, fat_b = b._get_directory()
+    return [trk for trk in range(0, max(a.no_tracks(), b.no_tracks())) if fat_a[trk] != fat_b[trk]]
+
+def diff_programs(a: Disk, b: Disk, swechars=False, context: int=3) -> List[Tuple[str, List[str]]]:
+    # A unified diff of the listings of each BASIC program that is on both disks but with other contents
+    diffs = []
+    files_b = dict((f.filename, f) for f in b.get_files())
+    for fa in a.get_files():
+        fb = files_b.get(fa.filename)
+        if fb is None or not fa.is_basic_file() or not fb.is_basic_file():
+            continue
+        data_a = fa.read()
+        data_b = fb.read()
+        if data_a == data_b:
+            continue
+        lines = list(difflib.unified_diff(basic_tokenizer.detokenize(data_a, swechars),
+                                          basic_tokenizer.detokenize(data_b, swechars),
+                                          "a/" + fa.filename, "b/" + fb.filename, n=context, lineterm=""))
+        diffs.append((fa.filename, lines))
+    return diffs
+
+def data_track_hashes(disk: Disk) -> List[bytes]:
+    # Hashes of the tracks with data on them; empty tracks are on every disk, so they say nothing about it
+    usage = disk.get_track_usage()
+    return [track_hash(track) for trk, track in enumerate(disk.tracks) if usage[trk] != 0]
@@ -2,13 +2,26 @@ import logging
 from sviit.util import str_to_swechar
 import sys
 
-from sviit.disk import Disk
+from sviit.disk import Disk, SYSTEM_TRACKS
+
+def deleted_file_status(disk, file):
+    # How likely it is that the data of a deleted file is still on the disk
+    status = 'Data may exist'
+    usage = disk.get_track_usage()
+    for trk in file.tracks:
+        if trk >= len(usage) or not usage[trk]:
+            return 'Data is empty'
+        owners = disk.get_track_owners(trk)
+        if any(not owner.deleted for owner in owners):
+            return 'Data is overwritten'
+        if len(owners) > 1:
+            status = 'Data may be overwritten'
+    return status
 
 def show_track_usage(disk):
     side2_has_data = False
     print("Track usage: ",)
-    for trk_no in range(0, disk.no_tracks()):
-        cd = disk.track_contains_data(trk_no)
+    for trk_no, cd in enumerate(disk.get_track_usage()):
         if cd == 0:
             sys.stdout.write('.')
         elif cd < 0:
@@ -21,29 +34,21 @@ def show_track_usage(disk):
     if side2_has_data:
         print("Side 2 has data!")
 
+def boot_track_type(disk):
+    if b"Disk version" in bytes(disk.tracks[0]):
+        return "Disk Basic"
+    elif disk.track_contains_data(0):
+        return "Unknown data"
+    return "Empty"
+
 def show_boot_track(disk):
-    track = disk.tracks[0]
     print("Boot track:",)
-    if b"Disk version" in track:
-        print("Disk Basic")
-    elif disk.track_contains_data(0):
-        print("Unknown data")
-    else:
-        print("Empty")
+    print(boot_track_type(disk))
 
 def show_files(disk, swechars=False):
     files = disk.get_all_files()
 
     used_existing = [0] * disk.no_tracks()
-    used_deleted = [0] * disk.no_tracks()
-
-    ref_tracks = [False] * disk.no_tracks()
-    ref_tracks[0] = ref_tracks[1] = ref_tracks[2] = ref_tracks[20] = True
-    for file in files:
-        for trk_no in file.tracks:
-            if trk_no >= 0 and trk_no < disk.no_tracks():
-                ref_tracks[trk_no] = True
-
 
     has_deletes = False
     for file in files:
@@ -52,11 +57,8 @@ def show_files(disk, swechars=False):
         for trk in file.tracks:
             if trk < 0 or trk >= disk.no_tracks():
                 logging.warning('Invalid track reference for file %s: %d' % (file.filename, trk))
-            else:
-                if file.deleted:
-                    used_deleted[trk] += 1
-                else:
-                    used_existing[trk] += 1
+            elif not file.deleted:
+                used_existing[trk] += 1
 
     for x in range(0, disk.no_tracks()):
         if used_existing[x] >= 2:
@@ -67,7 +69,7 @@ def show_files(disk, swechars=False):
     for file in files:
         if file.deleted:
             continue
-        print('%-11s %s %5d bytes   Tracks: %s' % (str_to_swechar(file.displayname), file.attr, file.size, file.tracks))
+        print('%-11s %s %5d bytes   Tracks: %s' % (str_to_swechar(file.displayname), file.attr, file.size, file.tracks.tolist()))
     print()
 
     if has_deletes:
@@ -76,26 +78,57 @@ def show_files(disk, swechars=False):
         for file in files:
             if not file.deleted:
                 continue
-            status = 'Data may exist'
-            for trk in file.tracks:
-                if not disk.track_contains_data(trk):
-                    status = 'Data is empty'
-                    break
-                if used_existing[trk]:
-                    status = 'Data is overwritten'
-                    break
-                if used_deleted[trk] > 1:
-                    status = 'Data may be overwritten'
-
-            print('%-11s %s %5d bytes   Tracks: %-15s Status: %s' % (file.displayname, file.attr, file.size, file.tracks, status))
+            status = deleted_file_status(disk, file)
+            print('%-11s %s %5d bytes   Tracks: %-15s Status: %s' % (file.displayname, file.attr, file.size, file.tracks.tolist(), status))
         print()
 
-    for trk_no in range(0, disk.no_tracks()):
-        if disk.track_contains_data(trk_no) and not ref_tracks[trk_no]:
-            print('Track %d contains data but is not referenced in FAT!' % trk_no)
+    for trk_no in unreferenced_tracks(disk):
+        print('Track %d contains data but is not referenced in FAT!' % trk_no)
+
+def unreferenced_tracks(disk):
+    # Tracks that (probably) contain data, but aren't system tracks or used by any file, existing or deleted
+    return [trk_no for trk_no, cd in enumerate(disk.get_track_usage())
+            if cd and trk_no not in SYSTEM_TRACKS and not disk.get_track_owners(trk_no)]
+
+def inventory(disk, swechars=False):
+    # Everything show prints about a disk, as a dict that can be serialized to JSON
+    usage = disk.get_track_usage()
+    name = str_to_swechar if swechars else str
+
+    def file_record(file):
+        return {
+            "filename": name(file.filename),
+            "displayname": name(file.displayname).rstrip(),
+            "type": file.type,
+            "attr": file.attr.strip(),
+            "basic": file.is_basic_file(),
+            "size": file.size,
+            "tracks": file.tracks.tolist(),
+        }
+
+    deleted = []
+    for file in disk.get_deleted_files():
+        record = file_record(file)
+        record["status"] = deleted_file_status(disk, file)
+        deleted.append(record)
+
+    return {
+        "tracks": disk.no_tracks(),
+        "track_usage": "".join('.' if cd == 0 else '?' if cd < 0 else '#' for cd in usage),
+        "side2_has_data": any(usage[40:]),
+        "boot_track": boot_track_type(disk),
+        "has_fat": disk.has_fat(),
+        "attributes": disk.get_disk_attributes(),
+        "ipl": disk.get_ipl_command(),
+        "files": [file_record(file) for file in disk.get_files()],
+        "deleted_files": deleted,
+        "unreferenced_tracks": unreferenced_tracks(disk),
+    }
 
 def show(filename, swechars=False):
-    disk = Disk(filename)
+    show_disk(Disk(filename), swechars)
+
+def show_disk(disk, swechars=False):
     show_track_usage(disk)
     print()
     show_boot_track(disk)
@@ -2,44 +2,153 @@ import sys
 import os
 import os.path
 import logging
+import hashlib
+from typing import Dict, Iterable, List, Optional, Tuple
 
-from disk import Disk
-import basic_tokenizer
+from sviit.disk import Disk, File
+from sviit.util import atomic_write
+from sviit.manifest import ImageEntry, Manifest
+from sviit.images import ImageWorker, Source, basic_programs, find_images, iter_sources, map_images, member_path, open_image
+from sviit import archives, basic_tokenizer
 
-def extract(disk_image, output_path):
-    disk = Disk(disk_image)
-    if not os.path.exists(output_path):
-        os.makedirs(output_path)
-    if not disk.has_fat():
-        logging.info("Skipping %s, has no FAT" % os.path.basename(disk_image))
-        return
+
+def output_path_for(disk_image: str, inpath: str, outpathroot: str) -> str:
+    # Mirrors the directory structure of the input, with one directory per disk image
+    relpath = os.path.relpath(disk_image, inpath)
+    return os.path.join(outpathroot, os.path.splitext(relpath)[0])
+
+def safe_filename(filename: str) -> str:
+    return filename.replace(os.sep, '_').replace('\0', '_')
+
+def write_lines_atomic(filename: str, lines: Iterable[str]):
+    with atomic_write(filename) as tmpname:
+        with open(tmpname, "wt") as f:
+            for line in lines:
+                f.write(line)
+                f.write('\n')
+
+def write_bytes_atomic(filename: str, data: bytes):
+    with atomic_write(filename) as tmpname:
+        with open(tmpname, "wb") as f:
+            f.write(data)
+
+def extract_settings(swechars=False, output_path: str="") -> str:
+    # Everything besides the image contents that affects the output, including where it is written
+    return "%d:%d:%s" % (basic_tokenizer.TOKENIZER_VERSION, swechars, os.path.abspath(output_path))
+
+def remove_output(output_path: str, output: str):
+    try:
+        os.unlink(os.path.join(output_path, output))
+    except FileNotFoundError:
+        pass
+
+def extract_programs(disk: Disk, disk_image: str, output_path: str, swechars=False,
+                     known_files: Optional[Dict[str, Tuple[str, str]]]=None) -> Tuple[Dict[str, Tuple[str, str]], int]:
+    # Detokenizes the BASIC programs on a disk, except those in known_files that are unchanged and already written.
+    # Returns the hash and output file of each program, and the number of programs that were detokenized.
+    files: Dict[str, Tuple[str, str]] = {}
+    extracted = 0
     logging.info('Extracting %s' % os.path.basename(disk_image))
-    for f in disk.get_files():
-        if f.is_basic_file():
-            data = disk.read_file(f)
-            logging.info("Detokenizing %s" % f.filename)
-            lines = basic_tokenizer.detokenize(data)
-            with open(os.path.join(output_path, f.filename), "wt") as f:
-                for line in lines:
-                    f.write(line)
-                    f.write('\n')
-
-
-def main():
-    #extract('/Users/yarin/Dropbox/SVI/Disk/tokentest.dsk', '/Users/yarin/src/svitools/tokentest')
-    #extract('/Users/yarin/Dropbox/SVI/Disk/ripped/80-disk3.dsk', '/Users/yarin/src/svitools/80-disk3')
-    #extract('/Users/yarin/Dropbox/SVI/Disk/ripped/musik.dsk', '/Users/yarin/src/svitools/musik')
-    #extract('/Users/yarin/Dropbox/SVI/Disk/ripped/disk1.dsk', '/Users/yarin/src/svitools/disk1')
-    inpath = '/Users/yarin/Dropbox/SVI/Disk/ripped/'
-    outpathroot = '/Users/yarin/src/svitools/out/'
-    for f in os.listdir(inpath):
-        (root, ext) = os.path.splitext(f)
-        if ext == '.dsk':
-            infile = os.path.join(inpath, f)
-            outpath = os.path.join(outpathroot, root)
-            #print infile, outpath
-            extract(infile, outpath)
+
+    def write_program(f: File) -> Tuple[str, str, bool]:
+        # The hash and output file of a program, and whether it was detokenized
+        data = f.read()
+        file_hash = hashlib.sha1(data).hexdigest()
+        output = safe_filename(f.filename)
+        if known_files is not None and known_files.get(f.filename) == (file_hash, output) and \
+                os.path.exists(os.path.join(output_path, output)):
+            return file_hash, output, False
+        logging.info("Detokenizing %s" % f.filename)
+        os.makedirs(output_path, exist_ok=True)
+        lines = (line for _, line in basic_tokenizer.iter_detokenize(data, swechars))
+        write_lines_atomic(os.path.join(output_path, output), lines)
+        return file_hash, output, True
+
+    for f, (file_hash, output, detokenized) in basic_programs(disk, disk_image, write_program):
+        files[f.filename] = (file_hash, output)
+        if detokenized:
+            extracted += 1
+    return files, extracted
+
+def extract(disk_image: str, output_path: str, swechars=False, known: Optional[ImageEntry]=None) -> Tuple[ImageEntry, int]:
+    # Extracts the BASIC programs on a disk image, skipping anything that is unchanged since the known extraction.
+    # Returns what has now been extracted from the image, and the number of programs that were detokenized.
+    settings = extract_settings(swechars, output_path)
+    reusable = known is not None and known.settings == settings
+    # Some of the output may have been removed since, then the programs are looked at again
+    complete = reusable and all(os.path.exists(os.path.join(output_path, output)) for _, output in known.files.values())
+
+    st = os.stat(disk_image)
+    if complete and (known.size, known.mtime_ns) == (st.st_size, st.st_mtime_ns):
+        return known, 0
+
+    with Disk(disk_image, use_mmap=True) as disk:
+        image_hash = disk.content_hash()
+        if complete and known.image_hash == image_hash:
+            return ImageEntry(st.st_size, st.st_mtime_ns, image_hash, settings, known.files), 0
+        files, extracted = extract_programs(disk, disk_image, output_path, swechars, known.files if reusable else None)
+
+    if known is not None:
+        outputs = set(output for _, output in files.values())
+        for _, output in known.files.values():
+            if output not in outputs:
+                remove_output(output_path, output)
+
+    return ImageEntry(st.st_size, st.st_mtime_ns, image_hash, settings, files), extracted
+
+def archive_output_path(member: str, outpathroot: str) -> str:
+    # Like output_path_for, for a disk image in an archive. The member name must not lead outside outpathroot.
+    return os.path.join(outpathroot, os.path.splitext(member_path(member))[0])
+
+def extract_source(disk_image: str, source: Source, output_path: str, swechars=False) -> int:
+    # Extracts the BASIC programs of a disk image, without a manifest. Returns the number of programs extracted.
+    with open_image(source) as disk:
+        return extract_programs(disk, disk_image, output_path, swechars)[1]
+
+def extract_archive(archive: str, outpathroot: str, workers: Optional[int]=None, swechars=False) -> List[Tuple[str, int, Optional[str]]]:
+    # Extracts the BASIC programs of all disk images in a zip or tar archive, without unpacking it.
+    # Only a few images are read ahead of the workers, so memory use doesn't depend on the size of the archive.
+    jobs = ((os.path.join(archive, member), data, archive_output_path(member, outpathroot), swechars)
+            for member, data in iter_sources(archive))
+    return list(map_images(ImageWorker(extract_source, "extract", 0), jobs, workers))
+
+def extract_all(inpath: str, outpathroot: str, workers: Optional[int]=None, swechars=False,
+                manifest_file: Optional[str]=None) -> List[Tuple[str, int, Optional[str]]]:
+    # With a manifest, images and programs that haven't changed since the last run are skipped,
+    # and the output of programs and images that have disappeared is removed.
+    if os.path.isfile(inpath) and archives.is_archive(inpath):
+        if manifest_file:
+            logging.warning("Can't use a manifest with an archive, extracting everything")
+        return extract_archive(inpath, outpathroot, workers, swechars)
+
+    manifest = Manifest(manifest_file) if manifest_file else None
+    known = manifest.get_images() if manifest else {}
+
+    jobs = []
+    for disk_image in find_images(inpath):
+        key = os.path.relpath(disk_image, inpath)
+        jobs.append((disk_image, output_path_for(disk_image, inpath, outpathroot), swechars, known.pop(key, None)))
+
+    for key, entry in known.items():
+        output_path = output_path_for(os.path.join(inpath, key), inpath, outpathroot)
+        for _, output in entry.files.values():
+            remove_output(output_path, output)
+        manifest.remove_image(key)
+
+    results = []
+    try:
+        for disk_image, (entry, extracted), error in map_images(ImageWorker(extract, "extract", (None, 0)), jobs, workers):
+            if manifest and entry is not None:
+                manifest.update_image(os.path.relpath(disk_image, inpath), entry)
+                if len(results) % 256 == 0:
+                    manifest.commit()
+            results.append((disk_image, extracted, error))
+    finally:
+        if manifest:
+            manifest.close()
+    return results
+
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
-    main()
+    extract_all(sys.argv[1], sys.argv[2])
@@ -0,0 +1,190 @@
+import os
+import os.path
+import json
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from sviit.disk import Disk, FAT_FREE, FAT_RESERVED, SYSTEM_TRACKS, fat_copies, is_formatted_fat, majority_fat
+from sviit.extract_basic_programs import write_lines_atomic
+from sviit.util import atomic_write
+from sviit.images import ImageWorker, Source, iter_sources, map_images, member_path, open_image
+
+"""
+Checks the directory and FAT of disk images, and optionally writes repaired copies of them.
+
+The FAT is taken byte by byte from the majority of the three copies on track 20. The chains of all existing
+files are then followed once, recording the owner of each track, which finds chains that run into another
+file's tracks (cross-linked), into their own tracks (circular), past the last track of the disk or into a
+system track. Tracks that are allocated in the FAT but owned by no file are lost.
+
+The first track of each file belongs to that file, since its directory entry says so; other cross-linked
+tracks belong to the file that comes first in the directory. A repair writes the majority FAT to all three
+copies, ends each broken chain on the last good track, marks files that don't even own their first track
+as deleted, and frees lost tracks. The original images are never modified.
+"""
+
+# The last track of a chain has 0xC0 plus the number of sectors used, a track has 17 sectors
+LAST_TRACK = 0xC0
+FULL_LAST_TRACK = LAST_TRACK + 17
+
+CROSS_LINKED = "cross-linked"
+CIRCULAR = "circular"
+OUT_OF_RANGE = "out of range"
+SYSTEM_TRACK = "system track"
+BAD_END = "bad end"
+LOST_TRACK = "lost track"
+
+# Owners in the track map, which otherwise holds the directory index of the file using each track
+NO_OWNER = 0xFF
+SYSTEM_OWNER = 0xFE
+
+
+def check(disk: Disk) -> Dict:
+    # Finds the problems in the directory and FAT of a disk, as a dict that can be serialized to JSON.
+    # Each problem has the file (None for lost tracks), its directory entry, the track where the
+    # problem is and the track before it in the chain.
+    dir_track = bytes(disk.tracks[20])
+    directory = dir_track[0:13*256]
+    copies = fat_copies(dir_track)
+    fat, mismatches = majority_fat(copies)
+    report = {
+        "tracks": disk.no_tracks(),
+        "has_fat": is_formatted_fat(fat),
+        "fat_mismatches": len(mismatches),
+        "bad_fat_copies": [i for i, copy in enumerate(copies) if copy != fat],
+        "problems": [],
+    }
+    if not report["has_fat"]:
+        return report
+
+    def problem(kind: str, file, track: int, previous: Optional[int], other=None):
+        report["problems"].append({
+            "problem": kind,
+            "file": file.filename if file is not None else None,
+            "entry": file.index_position if file is not None else None,
+            "track": track,
+            "previous": previous,
+            "other": other,
+        })
+
+    owners = bytearray([NO_OWNER]) * 256
+    for trk in SYSTEM_TRACKS:
+        owners[trk] = SYSTEM_OWNER
+    files = disk.get_files()
+    by_entry = dict((f.index_position, f) for f in files)
+    for f in files:
+        first = directory[f.index_position*16+10]
+        if first < disk.no_tracks() and owners[first] == NO_OWNER:
+            owners[first] = f.index_position
+    for f in files:
+        previous = None
+        fat_ptr = directory[f.index_position*16+10]
+        while fat_ptr < LAST_TRACK:
+            owner = owners[fat_ptr]
+            if fat_ptr >= disk.no_tracks():
+                problem(OUT_OF_RANGE, f, fat_ptr, previous)
+                break
+            if owner == f.index_position and previous is not None:
+                problem(CIRCULAR, f, fat_ptr, previous)
+                break
+            if owner == SYSTEM_OWNER:
+                problem(SYSTEM_TRACK, f, fat_ptr, previous)
+                break
+            if owner != NO_OWNER and owner != f.index_position:
+                problem(CROSS_LINKED, f, fat_ptr, previous, by_entry[owner].filename)
+                break
+            owners[fat_ptr] = f.index_position
+            previous = fat_ptr
+            fat_ptr = fat[fat_ptr]
+        else:
+            if previous is not None and fat_ptr > FULL_LAST_TRACK:
+                problem(BAD_END, f, previous, previous)
+
+    for trk in range(0, disk.no_tracks()):
+        if owners[trk] == NO_OWNER and fat[trk] not in (FAT_FREE, FAT_RESERVED):
+            problem(LOST_TRACK, None, trk, None)
+    return report
+
+def is_damaged(report: Dict) -> bool:
+    return report["has_fat"] and bool(report["problems"] or report["fat_mismatches"])
+
+def repair(disk: Disk, report: Dict):
+    # Fixes the problems found by check, see above
+    with disk.edit() as tx:
+        for p in report["problems"]:
+            if p["problem"] == LOST_TRACK:
+                tx.fat[p["track"]] = FAT_FREE
+            elif p["previous"] is not None:
+                tx.fat[p["previous"]] = FULL_LAST_TRACK
+            else:
+                tx.directory[p["entry"]*16] = 0
+        # Also writes the majority FAT to all copies
+        tx.directory_changed = True
+
+def save_copy(disk: Disk, output: str):
+    # Always writes a new file, which replaces output when complete. Disk.save_to_file would update the
+    # file in place if output is where the image was loaded from.
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with atomic_write(output) as tmpname:
+        disk.save_to_file(tmpname)
+
+def fsck(disk: Disk, output: Optional[str]=None) -> Dict:
+    # Checks a disk and, if it is damaged and output is given, saves a repaired copy there
+    report = check(disk)
+    report["repaired"] = None
+    if output is not None and is_damaged(report):
+        repair(disk, report)
+        save_copy(disk, output)
+        report["repaired"] = output
+    return report
+
+def is_same_file(source: str, output: str) -> bool:
+    return os.path.realpath(source) == os.path.realpath(output) or \
+        (os.path.exists(output) and os.path.samefile(source, output))
+
+def fsck_image(disk_image: str, source: Source, output: Optional[str]=None) -> Dict:
+    if output is not None and isinstance(source, str) and is_same_file(source, output):
+        raise Exception("The repaired copy would replace the original image")
+    with open_image(source) as disk:
+        return fsck(disk, output)
+
+def fsck_all(inpath: str, outpathroot: Optional[str]=None, workers: Optional[int]=None) -> Iterator[Tuple[str, Optional[Dict], Optional[str]]]:
+    # Checks all disk images in a directory or archive, or a single image, yielding the image, its report
+    # and the error if it couldn't be checked. Repaired copies are written below outpathroot, with the same
+    # relative path as the image.
+    jobs = ((name, source, os.path.join(outpathroot, member_path(name)) if outpathroot is not None else None)
+            for name, source in iter_sources(inpath))
+    return map_images(ImageWorker(fsck_image, "check", None), jobs, workers)
+
+def summarize(results: List[Tuple[str, Optional[Dict], Optional[str]]]) -> Dict:
+    # Totals over all images, and the reports of the damaged ones
+    summary = {
+        "images": len(results),
+        "clean": 0,
+        "damaged": 0,
+        "no_fat": 0,
+        "repaired": 0,
+        "fat_mismatches": 0,
+        "problems": {},
+        "failed": {},
+        "damaged_images": {},
+    }
+    for disk_image, report, error in results:
+        if error is not None:
+            summary["failed"][disk_image] = error
+        elif not report["has_fat"]:
+            summary["no_fat"] += 1
+        elif not is_damaged(report):
+            summary["clean"] += 1
+        else:
+            summary["damaged"] += 1
+            if report["fat_mismatches"]:
+                summary["fat_mismatches"] += 1
+            if report["repaired"] is not None:
+                summary["repaired"] += 1
+            for p in report["problems"]:
+                summary["problems"][p["problem"]] = summary["problems"].get(p["problem"], 0) + 1
+            summary["damaged_images"][disk_image] = report
+    return summary
+
+def write_report(summary: Dict, filename: str):
+    write_lines_atomic(filename, [json.dumps(summary, indent=2)])
@@ -0,0 +1,142 @@
+import os
+import os.path
+import copy
+import logging
+import itertools
+import collections
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Generic, Iterable, Iterator, List, Optional, Tuple, TypeVar, Union
+
+from sviit.disk import Disk, File
+from sviit import archives
+
+"""
+Finds the disk images of a collection, and runs work on each of them in worker processes.
+
+A collection is a directory tree of image files, a zip or tar archive of them, or a single image file. Each
+image is named by its path relative to the collection (the member name for an image in an archive) and is
+given to the workers as its filename or, for an image in an archive, its contents.
+"""
+
+IMAGE_EXTENSIONS = ('.dsk',)
+# Jobs are sent to the worker processes this many at a time, and this many batches per worker are queued
+CHUNK_SIZE = 8
+QUEUED_CHUNKS = 2
+
+# The filename of an image, or the contents of an image in an archive
+Source = Union[str, bytes]
+
+J = TypeVar("J")
+R = TypeVar("R")
+
+
+def find_images(inpath: str) -> Iterator[str]:
+    for root, dirs, files in os.walk(inpath):
+        dirs.sort()
+        for f in sorted(files):
+            if os.path.splitext(f)[1].lower() in IMAGE_EXTENSIONS:
+                yield os.path.join(root, f)
+
+def member_path(member: str) -> str:
+    # A relative path for an archive member, which doesn't lead outside the directory it is joined with
+    parts = [part for part in member.replace("\\", "/").split("/") if part not in ("", ".", "..")]
+    return os.path.join(*parts) if parts else "_"
+
+def iter_sources(inpath: str) -> Iterator[Tuple[str, Source]]:
+    # The name and source of each disk image in a directory, a zip/tar archive or a single image file
+    if os.path.isfile(inpath) and archives.is_archive(inpath):
+        yield from archives.archive_images(inpath)
+    elif os.path.isdir(inpath):
+        for disk_image in find_images(inpath):
+            yield os.path.relpath(disk_image, inpath), disk_image
+    else:
+        # Also a file that doesn't exist, so that it's reported when it fails to open
+        yield os.path.basename(inpath), inpath
+
+def open_image(source: Source) -> Disk:
+    return Disk.from_bytes(source) if isinstance(source, bytes) else Disk(source, use_mmap=True)
+
+def basic_programs(disk: Disk, disk_image: str, read: Callable[[File], R]) -> Iterator[Tuple[File, R]]:
+    # Each BASIC program on a disk, with what read makes of it. A program that read fails on is logged and
+    # skipped, and a disk without a FAT has no programs.
+    if not disk.has_fat():
+        logging.info("Skipping %s, has no FAT" % os.path.basename(disk_image))
+        return
+    for f in disk.get_files():
+        if not f.is_basic_file():
+            continue
+        try:
+            result = read(f)
+        except Exception as e:
+            logging.warning("Failed to detokenize %s in %s: %s" % (f.filename, disk_image, e))
+            continue
+        yield f, result
+
+
+class ImageWorker(Generic[R]):
+    # A worker for map_images that runs function(*job) on a job whose first item is the name of its image,
+    # and returns the name, the result and None. An image that fails is logged and reported back as the
+    # name, a copy of empty and the error instead of aborting the run.
+    def __init__(self, function: Callable[..., R], action: str, empty: R):
+        self.function = function
+        self.action = action
+        self.empty = empty
+
+    def __call__(self, job: Tuple[Any, ...]) -> Tuple[str, R, Optional[str]]:
+        try:
+            return job[0], self.function(*job), None
+        except Exception as e:
+            logging.warning("Failed to %s %s: %s" % (self.action, job[0], e))
+            return job[0], copy.copy(self.empty), str(e)
+
+
+class DiskCache:
+    # The most recently used disks, kept open and reopened when the image file changes
+    def __init__(self, size: int):
+        self.size = max(1, size)
+        self.disks: "collections.OrderedDict[str, Tuple[Tuple[int, int], Disk]]" = collections.OrderedDict()
+
+    def get(self, filename: str) -> Disk:
+        key = os.path.abspath(filename)
+        st = os.stat(filename)
+        version = (st.st_size, st.st_mtime_ns)
+        cached = self.disks.pop(key, None)
+        if cached is not None and cached[0] != version:
+            cached[1].close()
+            cached = None
+        if cached is None:
+            cached = (version, Disk(filename, use_mmap=True))
+            while len(self.disks) >= self.size:
+                _, (_, oldest) = self.disks.popitem(last=False)
+                oldest.close()
+        self.disks[key] = cached
+        return cached[1]
+
+    def close(self):
+        for _, disk in self.disks.values():
+            disk.close()
+        self.disks.clear()
+
+def _run_chunk(worker: Callable[[J], R], jobs: List[J]) -> List[R]:
+    return [worker(job) for job in jobs]
+
+def map_images(worker: Callable[[J], R], jobs: Iterable[J], workers: Optional[int]=None) -> Iterator[R]:
+    # Like map(worker, jobs), on a pool of worker processes unless workers is 1. The results come in the
+    # order of the jobs. Only a few jobs are taken ahead of the workers, so jobs can be a generator over
+    # a collection of any size, e.g. with the contents of the images in an archive.
+    if workers == 1:
+        yield from map(worker, jobs)
+        return
+
+    jobs = iter(jobs)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        max_pending = QUEUED_CHUNKS * (workers or os.cpu_count() or 1)
+        pending: "collections.deque" = collections.deque()
+        while True:
+            chunk = list(itertools.islice(jobs, CHUNK_SIZE))
+            if chunk:
+                pending.append(executor.submit(_run_chunk, worker, chunk))
+            if pending and (len(pending) >= max_pending or not chunk):
+                yield from pending.popleft().result()
+            elif not chunk:
+                break
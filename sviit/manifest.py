@@ -0,0 +1,70 @@
+import sqlite3
+from typing import Dict, Tuple
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    settings TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    image TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    output TEXT NOT NULL,
+    PRIMARY KEY (image, filename)
+);
+"""
+
+
+class ImageEntry:
+    # What was extracted from a disk image, and from which version of it.
+    # files maps each extracted filename to the hash of its contents and the name of the output file.
+    def __init__(self, size: int, mtime_ns: int, image_hash: str, settings: str, files: Dict[str, Tuple[str, str]]):
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.image_hash = image_hash
+        self.settings = settings
+        self.files = files
+
+
+class Manifest:
+    # A SQLite database remembering the extracted disk images, keyed by their path relative to the archive root
+    def __init__(self, filename: str):
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def commit(self):
+        self.db.commit()
+
+    def get_images(self) -> Dict[str, ImageEntry]:
+        images = {}
+        for path, size, mtime_ns, image_hash, settings in self.db.execute("SELECT path, size, mtime_ns, hash, settings FROM images"):
+            images[path] = ImageEntry(size, mtime_ns, image_hash, settings, {})
+        for image, filename, file_hash, output in self.db.execute("SELECT image, filename, hash, output FROM files"):
+            if image in images:
+                images[image].files[filename] = (file_hash, output)
+        return images
+
+    def update_image(self, path: str, entry: ImageEntry):
+        self.remove_image(path)
+        self.db.execute("INSERT INTO images (path, size, mtime_ns, hash, settings) VALUES (?, ?, ?, ?, ?)",
+                        (path, entry.size, entry.mtime_ns, entry.image_hash, entry.settings))
+        self.db.executemany("INSERT INTO files (image, filename, hash, output) VALUES (?, ?, ?, ?)",
+                            [(path, filename, file_hash, output) for filename, (file_hash, output) in entry.files.items()])
+
+    def remove_image(self, path: str):
+        self.db.execute("DELETE FROM images WHERE path = ?", (path,))
+        self.db.execute("DELETE FROM files WHERE image = ?", (path,))
@@ -0,0 +1,136 @@
+import sys
+import time
+import json
+import logging
+import functools
+from typing import Callable, Dict, List, Optional
+
+from sviit.disk import Disk, File
+from sviit import basic_tokenizer
+
+"""
+Per-stage timers and counters, for finding out where the time goes in a slow run.
+
+Nothing is measured until enable() is called, which replaces the functions of each stage with timed
+versions, so the code runs exactly as before when profiling is off. Stage times include the stages they
+call, e.g. detokenize includes read_float.
+"""
+
+enabled = False
+
+# Stage name -> [calls, seconds]
+timers: Dict[str, List[float]] = {}
+counters: Dict[str, int] = {}
+# Where a warning was logged -> [count, the first message]
+warnings: Dict[str, list] = {}
+
+
+def count(name: str, n: int=1):
+    counters[name] = counters.get(name, 0) + n
+
+def _timed(stage: str, func: Callable, after: Optional[Callable]=None) -> Callable:
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            timer = timers.get(stage)
+            if timer is None:
+                timer = timers[stage] = [0, 0.0]
+            timer[0] += 1
+            timer[1] += time.perf_counter() - start
+        if after is not None:
+            after(result)
+        return result
+    # Cached functions (lru_cache) keep their cache methods, which functools.wraps doesn't copy
+    for name in ("cache_clear", "cache_info"):
+        if hasattr(func, name):
+            setattr(wrapper, name, getattr(func, name))
+    return wrapper
+
+def _after_load(tracks):
+    count("image bytes read", sum(len(track) for track in tracks))
+
+def _after_read(data):
+    count("file bytes read", len(data))
+
+def _after_decode_line(decoded):
+    _, pieces, diagnostic = decoded
+    count("lines decoded")
+    # The first piece is the line number
+    count("tokens decoded", len(pieces) - 1)
+    if diagnostic:
+        count("broken lines")
+
+# Where to find each stage: the module or class, the name of the function and what to count afterwards
+STAGES = [
+    ("load_image", Disk, "load_from_file", _after_load),
+    ("load_image", Disk, "load_from_mmap", _after_load),
+    ("parse_directory", Disk, "_parse_all_files", None),
+    ("read_file", File, "read", _after_read),
+    ("detokenize", basic_tokenizer, "_decode_line", _after_decode_line),
+    ("read_float", basic_tokenizer, "decode_float", None),
+    ("tokenize", basic_tokenizer, "tokenize_line", None),
+    ("save_image", Disk, "save_to_file", None),
+]
+
+
+class _WarningCounter(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.WARNING)
+
+    def emit(self, record):
+        count("warnings")
+        where = "%s:%d" % (record.module, record.lineno)
+        entry = warnings.get(where)
+        if entry is None:
+            warnings[where] = [1, record.getMessage()]
+        else:
+            entry[0] += 1
+
+
+def enable():
+    global enabled
+    if enabled:
+        return
+    enabled = True
+    for stage, owner, name, after in STAGES:
+        setattr(owner, name, _timed(stage, getattr(owner, name), after))
+    root = logging.getLogger()
+    if not root.handlers:
+        # Without any handlers, warnings are printed by logging.lastResort, which a handler would turn off
+        root.addHandler(logging.StreamHandler())
+    root.addHandler(_WarningCounter())
+
+def summary() -> Dict:
+    return {
+        "stages": {stage: {"calls": calls, "seconds": seconds} for stage, (calls, seconds) in timers.items()},
+        "counters": dict(counters),
+        "warnings": [{"where": where, "count": n, "message": message}
+                     for where, (n, message) in sorted(warnings.items(), key=lambda item: -item[1][0])],
+    }
+
+def format_summary() -> str:
+    lines = ["%-20s %10s %12s" % ("Stage", "Calls", "Seconds")]
+    for stage, (calls, seconds) in sorted(timers.items(), key=lambda item: -item[1][1]):
+        lines.append("%-20s %10d %12.4f" % (stage, calls, seconds))
+    if counters:
+        lines.append("")
+        for name, n in sorted(counters.items()):
+            lines.append("%-20s %10d" % (name, n))
+    if warnings:
+        lines.append("")
+        lines.append("Warnings:")
+        for where, (n, message) in sorted(warnings.items(), key=lambda item: -item[1][0]):
+            lines.append("%8d  %-28s %s" % (n, where, message))
+    return "\n".join(lines)
+
+def dump(output_format: str="text", filename: Optional[str]=None):
+    # Writes the summary to a file, or to stderr
+    text = json.dumps(summary(), indent=2) if output_format == "json" else format_summary()
+    if filename is None:
+        sys.stderr.write(text + "\n")
+    else:
+        with open(filename, "w") as f:
+            f.write(text + "\n")
@@ -0,0 +1,131 @@
+import os
+import os.path
+import sqlite3
+from typing import Iterator, List, Optional, Tuple
+
+from sviit.util import atomic_write
+from sviit.images import ImageWorker, basic_programs, find_images, map_images, open_image
+from sviit import basic_tokenizer
+
+"""
+An inverted index over all BASIC programs in a collection of disk images.
+
+Every line is indexed by its tokens (keywords, names, constants and words in strings and comments)
+and by each pair of consecutive tokens, so a query for a sequence of tokens only needs to check the
+lines containing all of its token pairs.
+"""
+
+SCHEMA = """
+CREATE TABLE programs (
+    id INTEGER PRIMARY KEY,
+    image TEXT NOT NULL,
+    filename TEXT NOT NULL
+);
+CREATE TABLE lines (
+    id INTEGER PRIMARY KEY,
+    program INTEGER NOT NULL,
+    line_number INTEGER,
+    text TEXT NOT NULL,
+    tokens TEXT NOT NULL
+);
+CREATE TABLE postings (
+    term TEXT NOT NULL,
+    line INTEGER NOT NULL,
+    PRIMARY KEY (term, line)
+) WITHOUT ROWID;
+"""
+
+# Separates the tokens of a line in the lines table
+TOKEN_SEPARATOR = "\x1f"
+
+# A program as read by a worker: filename and the line number, text and tokens of each line
+ProgramLines = Tuple[str, List[Tuple[Optional[int], str, List[str]]]]
+
+
+def line_terms(tokens: List[str]) -> set:
+    terms = set(tokens)
+    terms.update("%s %s" % (a, b) for a, b in zip(tokens, tokens[1:]))
+    return terms
+
+def read_programs(disk_image: str, swechars=False) -> List[ProgramLines]:
+    with open_image(disk_image) as disk:
+        return [(f.filename, lines) for f, lines in
+                basic_programs(disk, disk_image, lambda f: list(basic_tokenizer.iter_tokens(f.read(), swechars)))]
+
+def build(inpath: str, index_file: str, workers: Optional[int]=None, swechars=False) -> Tuple[int, int, List[Tuple[str, str]]]:
+    # Indexes all BASIC programs in the disk images below inpath, replacing any previous index.
+    # Returns the number of programs and lines indexed, and the images that failed.
+    jobs = [(disk_image, swechars) for disk_image in find_images(inpath)]
+    num_programs = num_lines = 0
+    failed = []
+    with atomic_write(index_file) as tmpname:
+        db = sqlite3.connect(tmpname)
+        try:
+            db.executescript(SCHEMA)
+            for disk_image, programs, error in map_images(ImageWorker(read_programs, "index", []), jobs, workers):
+                if error is not None:
+                    failed.append((disk_image, error))
+                image = os.path.relpath(disk_image, inpath)
+                for filename, lines in programs:
+                    program_id = db.execute("INSERT INTO programs (image, filename) VALUES (?, ?)", (image, filename)).lastrowid
+                    num_programs += 1
+                    for line_number, text, tokens in lines:
+                        line_id = db.execute("INSERT INTO lines (program, line_number, text, tokens) VALUES (?, ?, ?, ?)",
+                                             (program_id, line_number, text, TOKEN_SEPARATOR.join(tokens))).lastrowid
+                        db.executemany("INSERT INTO postings (term, line) VALUES (?, ?)",
+                                       [(term, line_id) for term in line_terms(tokens)])
+                        num_lines += 1
+            db.commit()
+        finally:
+            db.close()
+    return num_programs, num_lines, failed
+
+def parse_query(query: str) -> Tuple[List[str], bool]:
+    # Returns the tokens to search for, and whether the last one is a prefix (ends with *)
+    query = query.strip().upper()
+    prefix = query.endswith("*")
+    if prefix:
+        query = query[:-1]
+    return basic_tokenizer.split_words(query), prefix
+
+def _matches(line_tokens: List[str], tokens: List[str], prefix: bool) -> bool:
+    n = len(tokens)
+    for i in range(0, len(line_tokens) - n + 1):
+        if line_tokens[i:i+n-1] == tokens[:-1] and \
+                (line_tokens[i+n-1].startswith(tokens[-1]) if prefix else line_tokens[i+n-1] == tokens[-1]):
+            return True
+    return False
+
+def query(index_file: str, text: str, limit: Optional[int]=None) -> Iterator[Tuple[str, str, Optional[int], str]]:
+    # Yields image, filename, line number and text of every line containing the tokens of the query in sequence
+    tokens, prefix = parse_query(text)
+    if not tokens:
+        return
+    terms = [tokens[0]] if len(tokens) == 1 else ["%s %s" % (a, b) for a, b in zip(tokens, tokens[1:])]
+
+    conditions = []
+    params: List[str] = []
+    for i, term in enumerate(terms):
+        if prefix and i == len(terms) - 1:
+            conditions.append("SELECT line FROM postings WHERE term >= ? AND term < ?")
+            params += [term, term + "\uffff"]
+        else:
+            conditions.append("SELECT line FROM postings WHERE term = ?")
+            params.append(term)
+
+    db = sqlite3.connect(index_file)
+    try:
+        sql = """SELECT programs.image, programs.filename, lines.line_number, lines.text, lines.tokens
+                 FROM lines JOIN programs ON programs.id = lines.program
+                 WHERE lines.id IN (%s) ORDER BY lines.id""" % " INTERSECT ".join(conditions)
+        found = 0
+        for image, filename, line_number, text, line_tokens in db.execute(sql, params):
+            # The index only says that all token pairs are on the line, check that they are in sequence
+            if len(tokens) > 2 and not _matches(line_tokens.split(TOKEN_SEPARATOR), tokens, prefix):
+                continue
+            yield image, filename, line_number, text
+            found += 1
+            if limit is not None and found >= limit:
+                break
+    finally:
+        db.close()
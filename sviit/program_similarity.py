@@ -0,0 +1,118 @@
+import os.path
+import hashlib
+import random
+from array import array
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from sviit.images import ImageWorker, basic_programs, find_images, map_images, open_image
+from sviit import basic_tokenizer, util
+
+"""
+Finds families of near-identical BASIC programs across a collection of disk images.
+
+Each program is reduced to the set of its token shingles (runs of consecutive tokens), with line numbers,
+line number references and Swedish character variants normalized away. A MinHash signature estimates the
+Jaccard similarity of two such sets, and locality-sensitive hashing of the signatures in bands finds the
+candidate pairs without comparing all programs with each other.
+"""
+
+SHINGLE_SIZE = 4
+NUM_HASHES = 64
+BANDS = 16
+ROWS = NUM_HASHES // BANDS
+
+# Each MinHash function xors the shingle hashes with its own random mask before taking the minimum
+_MASKS = [random.Random(1978 + i).getrandbits(64) for i in range(NUM_HASHES)]
+
+# Swedish characters and the ASCII characters they replace are treated as the same character
+_FOLD_SWECHARS = str.maketrans({c: s.upper() for c, s in list(util.SWE_CHARS.items()) +
+                                [(s, s) for s in util.SWE_CHARS.values()]})
+
+_LINE_REF_KEYWORDS = set(basic_tokenizer.LINE_REF_KEYWORDS)
+
+
+def normalized_tokens(data: bytes) -> List[str]:
+    # The tokens of a program, with line numbers referred to replaced by #, and a / separating the lines
+    tokens = []
+    for line_number, _, line_tokens in basic_tokenizer.iter_tokens(data):
+        if line_number is None:
+            continue
+        line_refs = False
+        for token in line_tokens:
+            if line_refs and token.isdigit():
+                token = "#"
+            elif token not in (",", "-"):
+                line_refs = token in _LINE_REF_KEYWORDS
+            tokens.append(token.translate(_FOLD_SWECHARS))
+        tokens.append("/")
+    return tokens
+
+def shingle_hashes(tokens: List[str]) -> List[int]:
+    # 64 bit hashes of all runs of SHINGLE_SIZE consecutive tokens. These must be the same in every process,
+    # so Python's own (randomized) string hashing can't be used.
+    shingles = set("\x1f".join(tokens[i:i+SHINGLE_SIZE]) for i in range(0, max(1, len(tokens) - SHINGLE_SIZE + 1)))
+    return [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "little") for s in shingles]
+
+def minhash(hashes: List[int]) -> array:
+    if not hashes:
+        return array("Q", [0] * NUM_HASHES)
+    numpy = util.import_numpy()
+    if numpy is not None:
+        values = numpy.array(hashes, dtype=numpy.uint64)
+        masks = numpy.array(_MASKS, dtype=numpy.uint64)
+        return array("Q", numpy.bitwise_xor.outer(values, masks).min(axis=0).tolist())
+    return array("Q", [min(h ^ mask for h in hashes) for mask in _MASKS])
+
+def similarity(a: Sequence[int], b: Sequence[int]) -> float:
+    # Estimated Jaccard similarity of the shingle sets
+    return sum(1 for x, y in zip(a, b) if x == y) / NUM_HASHES
+
+def image_signatures(disk_image: str) -> List[Tuple[str, array]]:
+    with open_image(disk_image) as disk:
+        return [(f.filename, minhash(shingle_hashes(tokens))) for f, tokens in
+                basic_programs(disk, disk_image, lambda f: normalized_tokens(f.read())) if tokens]
+
+def find_families(inpath: str, threshold: float=0.7, workers: Optional[int]=None) -> List[List[Tuple[str, str, float]]]:
+    # Groups the BASIC programs in all disk images below inpath into families of similar programs.
+    # Returns the families with more than one member, largest first, as (image, filename, similarity to the
+    # first member) tuples.
+    jobs = [(disk_image,) for disk_image in find_images(inpath)]
+    names: List[Tuple[str, str]] = []
+    signatures = array("Q")
+    buckets: List[Dict[bytes, int]] = [{} for _ in range(BANDS)]
+    parent: List[int] = []
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for disk_image, program_signatures, _ in map_images(ImageWorker(image_signatures, "read", []), jobs, workers):
+        image = os.path.relpath(disk_image, inpath)
+        for filename, signature in program_signatures:
+            program = len(names)
+            names.append((image, filename))
+            signatures.extend(signature)
+            parent.append(program)
+            # Each band bucket remembers its first program only, and later programs in the same bucket
+            # are compared with it, so the work stays linear even for programs found on many images
+            for band in range(BANDS):
+                key = signature[band*ROWS:(band+1)*ROWS].tobytes()
+                first = buckets[band].setdefault(key, program)
+                if first != program and find(first) != find(program) and \
+                        similarity(signature, signatures[first*NUM_HASHES:(first+1)*NUM_HASHES]) >= threshold:
+                    parent[find(program)] = find(first)
+
+    members: Dict[int, List[int]] = {}
+    for program in range(len(names)):
+        members.setdefault(find(program), []).append(program)
+
+    families = []
+    for programs in members.values():
+        if len(programs) < 2:
+            continue
+        first = signatures[programs[0]*NUM_HASHES:(programs[0]+1)*NUM_HASHES]
+        families.append([names[p] + (similarity(first, signatures[p*NUM_HASHES:(p+1)*NUM_HASHES]),) for p in programs])
+    families.sort(key=lambda family: -len(family))
+    return families
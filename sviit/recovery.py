@@ -0,0 +1,164 @@
+import os
+import os.path
+import json
+import logging
+from typing import Dict, List, Optional, Set, Tuple
+
+from sviit.disk import Disk, SYSTEM_TRACKS
+from sviit.extract_basic_programs import output_path_for, safe_filename, write_bytes_atomic, write_lines_atomic
+from sviit.images import ImageWorker, find_images, map_images, open_image
+from sviit.disk_viewer import deleted_file_status, unreferenced_tracks
+from sviit import basic_tokenizer
+
+"""
+Recovers BASIC programs from deleted files and from tracks that no file refers to.
+
+A tokenized program is a chain of lines, each starting with a pointer to the next line (relative to the
+load address 0x8001) and a line number, and ending with a 0 byte. Starting at the first track of a deleted
+file or an orphan track, the chain is followed for as long as it stays valid, continuing onto the next
+unused track if the program doesn't fit in the tracks of the file. Whatever was found is written out as
+a raw tokenized program and detokenized, and everything tried is listed in a JSON report.
+"""
+
+REPORT_FILE = "recovery.json"
+LOAD_ADDRESS = 0x8001
+MAX_LINE_NUMBER = 65529
+# A tokenized line is at most 255 bytes, plus its pointer and line number
+MAX_LINE_SIZE = 260
+# The largest program that fits in memory spans at most this many tracks
+MAX_TRACKS = 8
+
+CARVE_COMPLETE = "complete"
+CARVE_TRUNCATED = "truncated"
+CARVE_BROKEN = "broken"
+
+
+def carve_program(data) -> Tuple[int, int, str]:
+    # Follows the line pointer chain from the start of data for as long as it looks like a valid program.
+    # Returns the size of the valid lines, the number of lines, and whether the program ended properly,
+    # ran past the end of data or hit something that isn't a program line.
+    pos = 0
+    lines = 0
+    last_line_number = -1
+    size = len(data)
+    while True:
+        if pos + 2 > size:
+            return pos, lines, CARVE_TRUNCATED
+        next_row = data[pos] + data[pos+1] * 256
+        if next_row == 0:
+            return pos, lines, CARVE_COMPLETE
+        next_row -= LOAD_ADDRESS
+        # Pointer, line number and the terminating 0 byte
+        if next_row < pos + 5 or next_row - pos > MAX_LINE_SIZE:
+            return pos, lines, CARVE_BROKEN
+        if next_row > size:
+            return pos, lines, CARVE_TRUNCATED
+        line_number = data[pos+2] + data[pos+3] * 256
+        if data[next_row-1] != 0 or line_number <= last_line_number or line_number > MAX_LINE_NUMBER:
+            return pos, lines, CARVE_BROKEN
+        last_line_number = line_number
+        lines += 1
+        pos = next_row
+
+def _is_free(disk: Disk, trk: int, used: Set[int]) -> bool:
+    # Whether a track may hold the continuation of a carved program
+    return 0 <= trk < disk.no_tracks() and trk not in SYSTEM_TRACKS and trk not in used and \
+        disk.get_track_usage()[trk] != 0 and not any(not owner.deleted for owner in disk.get_track_owners(trk))
+
+def carve_tracks(disk: Disk, tracks: List[int], used: Set[int]) -> Tuple[bytes, List[int], str]:
+    # Carves a program starting on the given tracks, continuing onto the following free tracks if needed.
+    # Returns the tokenized program (including the final 0 word), the tracks it is stored on and how it ended.
+    tracks = [trk for trk in tracks[:MAX_TRACKS] if 0 <= trk < disk.no_tracks()]
+    data = bytearray()
+    for trk in tracks:
+        data += disk.tracks[trk]
+    while True:
+        end, lines, state = carve_program(data)
+        if state != CARVE_TRUNCATED or not tracks or len(tracks) >= MAX_TRACKS:
+            break
+        next_track = tracks[-1] + 1
+        if next_track in SYSTEM_TRACKS:
+            next_track += 1
+        if not _is_free(disk, next_track, used):
+            break
+        tracks.append(next_track)
+        data += disk.tracks[next_track]
+    if lines == 0:
+        return b"", [], state
+    # Only the tracks up to the end of the program
+    needed = []
+    size = 0
+    for trk in tracks:
+        if size > end:
+            break
+        needed.append(trk)
+        size += len(disk.tracks[trk])
+    return bytes(data[:end]) + b"\0\0", needed, state
+
+def recover(disk_image: str, output_path: str, swechars=False) -> List[Dict]:
+    # Tries to recover every deleted file and orphan track on a disk image, writing what is found below
+    # output_path. Returns a report entry for each attempt.
+    report = []
+    with open_image(disk_image) as disk:
+        if not disk.has_fat():
+            logging.info("Skipping %s, has no FAT" % os.path.basename(disk_image))
+            return report
+
+        used: Set[int] = set()
+        candidates = []
+        for f in disk.get_deleted_files():
+            if f.tracks:
+                # The same name is often deleted several times, so the directory entry is part of the output name
+                output = "deleted_%03d_%s" % (f.index_position, f.filename.lstrip("?"))
+                candidates.append(("deleted", f.filename, output, f.tracks.tolist(), deleted_file_status(disk, f)))
+        for trk in unreferenced_tracks(disk):
+            candidates.append(("orphan", "track%02d" % trk, "orphan_track%02d" % trk, [trk], None))
+
+        for source, name, output, tracks, status in candidates:
+            if source == "orphan" and tracks[0] in used:
+                # Already recovered as the continuation of another program
+                continue
+            program, program_tracks, state = carve_tracks(disk, tracks, used)
+            entry = {
+                "source": source,
+                "name": name,
+                "tracks": program_tracks or tracks,
+                "status": status,
+                "lines": 0,
+                "size": len(program),
+                "complete": state == CARVE_COMPLETE,
+                "output": None,
+            }
+            if program:
+                used.update(program_tracks)
+                output = safe_filename(output)
+                os.makedirs(output_path, exist_ok=True)
+                write_bytes_atomic(os.path.join(output_path, output + ".bin"), program)
+                lines = [line for _, line in basic_tokenizer.iter_detokenize(program, swechars)]
+                write_lines_atomic(os.path.join(output_path, output), lines)
+                entry["lines"] = len(lines)
+                entry["output"] = output
+            report.append(entry)
+    return report
+
+def recover_all(inpath: str, outpathroot: str, workers: Optional[int]=None, swechars=False) -> Tuple[List[Dict], List[Tuple[str, str]]]:
+    # Recovers programs from all disk images below inpath, and writes a report of all of them to outpathroot.
+    # Returns the report entries and the images that failed.
+    jobs = [(disk_image, output_path_for(disk_image, inpath, outpathroot), swechars) for disk_image in find_images(inpath)]
+    report = []
+    failed = []
+    for disk_image, entries, error in map_images(ImageWorker(recover, "recover", []), jobs, workers):
+        if error is not None:
+            failed.append((disk_image, error))
+        image = os.path.relpath(disk_image, inpath)
+        for entry in entries:
+            entry["image"] = image
+            if entry["output"] is not None:
+                entry["output"] = os.path.relpath(
+                    os.path.join(output_path_for(disk_image, inpath, outpathroot), entry["output"]), outpathroot)
+            report.append(entry)
+
+    os.makedirs(outpathroot, exist_ok=True)
+    lines = [json.dumps({"images": len(jobs), "failed": dict(failed), "candidates": report}, indent=2)]
+    write_lines_atomic(os.path.join(outpathroot, REPORT_FILE), lines)
+    return report, failed
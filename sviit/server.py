@@ -0,0 +1,155 @@
+import os
+import os.path
+import json
+import asyncio
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit, parse_qs
+
+from sviit.images import DiskCache, find_images
+from sviit import basic_tokenizer, disk_viewer
+
+"""
+A local, read-only HTTP service over a directory of disk images.
+
+    GET /images                                 the disk images, relative to the root directory
+    GET /image?path=IMAGE                       everything disk list shows about an image, as JSON
+    GET /file?image=IMAGE&name=FILE             the contents of a file
+    GET /listing?image=IMAGE&name=FILE          a BASIC program, detokenized (add &swechars=1 for Swedish characters)
+
+Opened disks, including their parsed directories, are kept in an LRU cache. Detokenizing is done on a pool
+of worker processes, so a large program doesn't hold up the other requests.
+"""
+
+MAX_HEADER_SIZE = 65536
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def _detokenize(data: bytes, swechars: bool) -> str:
+    # Runs in a worker process
+    return "".join(line + "\n" for _, line in basic_tokenizer.iter_detokenize(data, swechars))
+
+
+class ArchiveServer:
+    def __init__(self, root: str, cache_size: int=64, workers: Optional[int]=None):
+        self.root = os.path.realpath(root)
+        self.disks = DiskCache(cache_size)
+        self.pool = ProcessPoolExecutor(max_workers=workers)
+
+    def close(self):
+        self.pool.shutdown()
+        self.disks.close()
+
+    def image_path(self, path: Optional[str]) -> str:
+        # The image file, which must be below the root directory
+        if not path:
+            raise HttpError(400, "Missing image")
+        filename = os.path.realpath(os.path.join(self.root, path))
+        if not filename.startswith(self.root + os.sep) or not os.path.isfile(filename):
+            raise HttpError(404, "No such image: %s" % path)
+        return filename
+
+    def read_file(self, params: Dict[str, str]) -> bytes:
+        disk = self.disks.get(self.image_path(params.get("image")))
+        name = params.get("name")
+        if not name:
+            raise HttpError(400, "Missing name")
+        try:
+            f = disk.get_file(name, params.get("swechars") == "1")
+        except Exception:
+            raise HttpError(404, "No such file: %s" % name)
+        return f.read()
+
+    async def handle_request(self, path: str, params: Dict[str, str]) -> Tuple[int, str, bytes]:
+        # Returns the status, content type and body of the response
+        if path == "/images":
+            images = [os.path.relpath(f, self.root) for f in find_images(self.root)]
+            return 200, "application/json", json.dumps(images).encode("utf-8")
+        if path == "/image":
+            filename = self.image_path(params.get("path"))
+            record = disk_viewer.inventory(self.disks.get(filename), params.get("swechars") == "1")
+            record["image"] = os.path.relpath(filename, self.root)
+            return 200, "application/json", json.dumps(record).encode("utf-8")
+        if path == "/file":
+            return 200, "application/octet-stream", self.read_file(params)
+        if path == "/listing":
+            data = self.read_file(params)
+            loop = asyncio.get_running_loop()
+            text = await loop.run_in_executor(self.pool, _detokenize, data, params.get("swechars") == "1")
+            return 200, "text/plain; charset=utf-8", text.encode("utf-8")
+        raise HttpError(404, "Not found: %s" % path)
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    header = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                lines = header.decode("latin-1").split("\r\n")
+                request = lines[0].split()
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        key, value = line.split(":", 1)
+                        headers[key.strip().lower()] = value.strip()
+                keep_alive = len(request) == 3 and request[2] == "HTTP/1.1" and \
+                    headers.get("connection", "").lower() != "close"
+                try:
+                    content_length = headers.get("content-length", "0") or "0"
+                    if not content_length.isdigit():
+                        # The end of the request is unknown, so the connection can't be used for another one
+                        keep_alive = False
+                        raise HttpError(400, "Bad Content-Length")
+                    if int(content_length):
+                        try:
+                            await reader.readexactly(int(content_length))
+                        except asyncio.IncompleteReadError:
+                            break
+                    if len(request) != 3:
+                        raise HttpError(400, "Bad request line")
+                    if request[0] not in ("GET", "HEAD"):
+                        raise HttpError(405, "Only GET is supported")
+                    url = urlsplit(request[1])
+                    params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                    status, content_type, body = await self.handle_request(url.path, params)
+                except HttpError as e:
+                    status, content_type, body = e.status, "application/json", json.dumps({"error": str(e)}).encode("utf-8")
+                except Exception as e:
+                    logging.exception(e)
+                    status, content_type, body = 500, "application/json", json.dumps({"error": str(e)}).encode("utf-8")
+
+                writer.write(("HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: %s\r\n\r\n" % (
+                    status, REASONS.get(status, ""), content_type, len(body), "keep-alive" if keep_alive else "close")
+                              ).encode("latin-1"))
+                if request[:1] != ["HEAD"]:
+                    writer.write(body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str, port: int):
+        server = await asyncio.start_server(self.handle_connection, host, port, limit=MAX_HEADER_SIZE, backlog=1024)
+        async with server:
+            await server.serve_forever()
+
+
+def serve(root: str, host: str="127.0.0.1", port: int=8328, cache_size: int=64, workers: Optional[int]=None):
+    archive = ArchiveServer(root, cache_size, workers)
+    try:
+        asyncio.run(archive.serve(host, port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        archive.close()
@@ -0,0 +1,83 @@
+import random
+from typing import List
+
+from sviit.disk import Disk, SIZE_TRACK_0, SIZE_TRACK_X, FAT_FREE, FAT_RESERVED, DIRECTORY_END, SYSTEM_TRACKS
+from sviit import basic_tokenizer
+
+"""
+Builds valid disk images with made up contents, for benchmarks and experiments.
+
+The same seed always gives the same image: a formatted directory track, a number of tokenized BASIC
+programs with lots of float constants and DATA lines, a binary file, some deleted files and a file
+whose FAT chain loops back on itself.
+"""
+
+FILL_BYTE = 0xE5
+BOOT_SIGNATURE = b"Disk version"
+
+_WORDS = ["HELLO", "SCORE", "LEVEL", "GAME OVER", "PLAYER", "HIGHSCORE", "SPACE", "PRESS ANY KEY", "HEJ", "TACK"]
+
+
+def formatted_tracks(double_sided=False) -> List[bytearray]:
+    # An empty disk, as left by formatting it in Disk Basic
+    tracks = [bytearray([FILL_BYTE]) * SIZE_TRACK_0]
+    tracks += [bytearray([FILL_BYTE]) * SIZE_TRACK_X for _ in range(79 if double_sided else 39)]
+    tracks[0][16:16+len(BOOT_SIGNATURE)] = BOOT_SIGNATURE
+
+    directory = bytes([DIRECTORY_END]) * (13*256)
+    dat = bytes(256)
+    fat = bytearray([FAT_FREE]) * 256
+    for trk in SYSTEM_TRACKS:
+        fat[trk] = FAT_RESERVED
+    tracks[20] = bytearray(directory + dat + fat + fat + fat)
+    return tracks
+
+def program_listing(rng: random.Random, num_lines: int) -> List[str]:
+    # A BASIC program with a mix of statements, most of them with float constants
+    lines = []
+    for i in range(num_lines):
+        line_number = (i + 1) * 10
+        kind = rng.random()
+        if kind < 0.35:
+            values = ",".join("%.*f" % (rng.randint(1, 6), rng.uniform(-1000, 1000)) for _ in range(rng.randint(4, 10)))
+            statement = "DATA %s" % values
+        elif kind < 0.6:
+            statement = "A%d#=%.12f*B%d+%g" % (i % 10, rng.uniform(0, 100), i % 7, rng.uniform(-1, 1))
+        elif kind < 0.75:
+            statement = 'PRINT "%s";X%d:IF X%d>%.3f THEN %d' % (rng.choice(_WORDS), i % 5, i % 5, rng.random(),
+                                                              rng.randint(1, num_lines) * 10)
+        elif kind < 0.85:
+            statement = "FOR I=1 TO %d:S=S+SIN(I*%.5f):NEXT I" % (rng.randint(2, 500), rng.random())
+        elif kind < 0.95:
+            statement = "POKE &H%04X,%d:GOSUB %d" % (rng.randint(0x8000, 0xFFFF), rng.randint(0, 255),
+                                                     rng.randint(1, num_lines) * 10)
+        else:
+            statement = "REM %s" % rng.choice(_WORDS)
+        lines.append("%d %s" % (line_number, statement))
+    return lines
+
+def generate_disk(seed: int=0, double_sided=False, num_programs: int=6) -> Disk:
+    rng = random.Random(seed)
+    disk = Disk.from_tracks(formatted_tracks(double_sided))
+    with disk.edit() as tx:
+        tx.dat[1:4] = b"RUN"
+        for i in range(num_programs):
+            program = basic_tokenizer.tokenize(program_listing(rng, rng.randint(50, 300)))
+            tx.create_file("prog%d" % i, 0x80, program)
+        tx.create_file("data", 0x01, bytes(rng.getrandbits(8) for _ in range(rng.randint(100, 3*SIZE_TRACK_X))))
+
+        # A file whose last track points back to its first one
+        tx.create_file("loop", 0x80, basic_tokenizer.tokenize(program_listing(rng, 400)))
+        first = tx.directory[tx.find_entry("loop")*16+10]
+        last = first
+        while tx.fat[last] < 0xC0:
+            last = tx.fat[last]
+        tx.fat[last] = first
+
+        # Deleted last, so their data is still there
+        for i in range(0, num_programs, 3):
+            tx.delete_file("prog%d" % i)
+    return disk
+
+def write_image(filename: str, seed: int=0, double_sided=False, num_programs: int=6):
+    generate_disk(seed, double_sided, num_programs).save_to_file(filename)
@@ -0,0 +1,185 @@
+import os
+import os.path
+import mmap
+import hashlib
+import sqlite3
+from typing import Dict, List, Optional, Tuple
+
+from sviit.disk import Disk
+
+"""
+A content-addressed store for a collection of disk images.
+
+Each unique track is stored once in a pack file, and each image is a list of track hashes.
+Since boot tracks, empty tracks and popular programs appear on many images, this takes a
+fraction of the space of the images themselves, and identical tracks or images can be found
+by looking up their hash.
+"""
+
+PACK_FILE = "tracks.pack"
+INDEX_FILE = "index.sqlite"
+HASH_SIZE = 20
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    hash BLOB PRIMARY KEY,
+    offset INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS images (
+    name TEXT PRIMARY KEY,
+    tracks BLOB NOT NULL,
+    hash BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS images_hash ON images (hash);
+CREATE TABLE IF NOT EXISTS image_tracks (
+    hash BLOB NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (hash, name)
+) WITHOUT ROWID;
+"""
+
+
+def track_hash(track) -> bytes:
+    return hashlib.sha1(track).digest()
+
+
+class TrackStore:
+    def __init__(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.db = sqlite3.connect(os.path.join(path, INDEX_FILE))
+        self.db.executescript(SCHEMA)
+        self._index_image_tracks()
+        self.pack = open(os.path.join(path, PACK_FILE), "ab+")
+        self._mmap: Optional[mmap.mmap] = None
+        self._view: Optional[memoryview] = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._unmap()
+        self.db.commit()
+        self.db.close()
+        self.pack.close()
+
+    def _unmap(self):
+        if self._mmap is not None:
+            try:
+                self._view.release()
+                self._mmap.close()
+            except BufferError:
+                # Disks loaded from the store are still using the mapping, it's closed when they are gone
+                pass
+            self._mmap = self._view = None
+
+    def _index_image_tracks(self):
+        # Stores created before the image_tracks table existed get it filled in from the image manifests
+        if self.db.execute("SELECT 1 FROM image_tracks LIMIT 1").fetchone() is None:
+            for name, in self.db.execute("SELECT name FROM images").fetchall():
+                self.db.executemany("INSERT OR IGNORE INTO image_tracks (hash, name) VALUES (?, ?)",
+                                    [(digest, name) for digest in self.get_track_hashes(name)])
+            self.db.commit()
+
+    def add_track(self, track) -> Tuple[bytes, bool]:
+        # Returns the hash of the track, and whether it was new to the store
+        digest = track_hash(track)
+        if self.db.execute("SELECT 1 FROM tracks WHERE hash = ?", (digest,)).fetchone():
+            return digest, False
+        self.pack.seek(0, os.SEEK_END)
+        offset = self.pack.tell()
+        self.pack.write(track)
+        self.db.execute("INSERT INTO tracks (hash, offset, size) VALUES (?, ?, ?)", (digest, offset, len(track)))
+        return digest, True
+
+    def add_image(self, name: str, disk: Disk) -> int:
+        # Stores the image under the given name, replacing any image with the same name.
+        # Returns the number of tracks that weren't already in the store.
+        new_tracks = 0
+        digests = []
+        for track in disk.tracks:
+            digest, new = self.add_track(track)
+            digests.append(digest)
+            new_tracks += new
+        # The pack data must be on disk before the index refers to it
+        self.pack.flush()
+        manifest = b"".join(digests)
+        self.db.execute("INSERT OR REPLACE INTO images (name, tracks, hash) VALUES (?, ?, ?)",
+                        (name, manifest, hashlib.sha1(manifest).digest()))
+        self.db.execute("DELETE FROM image_tracks WHERE name = ?", (name,))
+        self.db.executemany("INSERT OR IGNORE INTO image_tracks (hash, name) VALUES (?, ?)",
+                            [(digest, name) for digest in digests])
+        self.db.commit()
+        return new_tracks
+
+    def remove_image(self, name: str):
+        # The tracks stay in the pack file
+        self.db.execute("DELETE FROM images WHERE name = ?", (name,))
+        self.db.execute("DELETE FROM image_tracks WHERE name = ?", (name,))
+        self.db.commit()
+
+    def get_names(self) -> List[str]:
+        return [name for name, in self.db.execute("SELECT name FROM images ORDER BY name")]
+
+    def get_track_hashes(self, name: str) -> List[bytes]:
+        row = self.db.execute("SELECT tracks FROM images WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            raise KeyError(name)
+        manifest = row[0]
+        return [manifest[i:i+HASH_SIZE] for i in range(0, len(manifest), HASH_SIZE)]
+
+    def find_duplicates(self, name: str) -> List[str]:
+        # Other images with exactly the same contents
+        return [other for other, in self.db.execute(
+            "SELECT name FROM images WHERE hash = (SELECT hash FROM images WHERE name = ?) AND name != ? ORDER BY name",
+            (name, name))]
+
+    def rank_by_shared_tracks(self, hashes: List[bytes], limit: Optional[int]=None) -> List[Tuple[str, int]]:
+        # The images with most of the given tracks, and how many of them each has, using the track index
+        # so only images sharing at least one track are looked at
+        counts: Dict[str, int] = {}
+        unique = list(set(hashes))
+        for i in range(0, len(unique), 500):
+            chunk = unique[i:i+500]
+            query = "SELECT name, COUNT(*) FROM image_tracks WHERE hash IN (%s) GROUP BY name" % ",".join("?" * len(chunk))
+            for name, n in self.db.execute(query, chunk):
+                counts[name] = counts.get(name, 0) + n
+        ranked = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+        return ranked[:limit] if limit is not None else ranked
+
+    def load_image(self, name: str) -> Disk:
+        # The tracks of the returned disk are memoryviews into the pack file, so nothing is copied
+        hashes = self.get_track_hashes(name)
+        locations: Dict[bytes, Tuple[int, int]] = {}
+        for i in range(0, len(hashes), 500):
+            chunk = hashes[i:i+500]
+            query = "SELECT hash, offset, size FROM tracks WHERE hash IN (%s)" % ",".join("?" * len(chunk))
+            for digest, offset, size in self.db.execute(query, chunk):
+                locations[digest] = (offset, size)
+
+        view = self._get_view()
+        tracks = []
+        for digest in hashes:
+            offset, size = locations[digest]
+            tracks.append(view[offset:offset+size])
+        return Disk.from_tracks(tracks)
+
+    def _get_view(self) -> memoryview:
+        self.pack.flush()
+        size = os.fstat(self.pack.fileno()).st_size
+        if self._view is None or len(self._view) < size:
+            # Previously loaded disks keep the old mapping alive until they are gone
+            self._mmap = mmap.mmap(self.pack.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._mmap)
+        return self._view
+
+    def get_stats(self) -> Tuple[int, int, int]:
+        # Number of images, number of unique tracks and the size of the pack file
+        images = self.db.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+        tracks = self.db.execute("SELECT COUNT(*) FROM tracks").fetchone()[0]
+        self.pack.flush()
+        return images, tracks, os.fstat(self.pack.fileno()).st_size
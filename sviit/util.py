@@ -1,3 +1,12 @@
+import os
+import os.path
+import tempfile
+import contextlib
+from typing import Iterable, Iterator, List
+
+# numpy is optional, and slow to import, so it's imported the first time some code asks for it
+_numpy = False
+
 SWE_CHARS = {
     "}": "å",
     "{": "ä",
@@ -9,22 +18,82 @@ SWE_CHARS = {
 
 SWE_CHARS_INVERSE = {v:k for k, v in SWE_CHARS.items()}
 
+# Precomputed tables. All the characters involved are in latin-1, so strings are translated by encoding them and
+# using bytes.translate, which is much faster than str.translate with characters outside ASCII.
+SWECHAR_TRANSLATION = str.maketrans(SWE_CHARS)
+SWECHAR_INVERSE_TRANSLATION = str.maketrans(SWE_CHARS_INVERSE)
+SWECHAR_BYTES_TRANSLATION = bytes.maketrans("".join(SWE_CHARS).encode("latin-1"),
+                                            "".join(SWE_CHARS.values()).encode("latin-1"))
+SWECHAR_BYTES_INVERSE_TRANSLATION = bytes.maketrans("".join(SWE_CHARS_INVERSE).encode("latin-1"),
+                                                    "".join(SWE_CHARS_INVERSE.values()).encode("latin-1"))
+_TOKENS_TO_SWECHAR = [SWE_CHARS.get(chr(token), chr(token)) for token in range(256)]
+_TOKENS_FROM_SWECHAR = [SWE_CHARS_INVERSE.get(chr(token), chr(token)) for token in range(256)]
+
 def str_to_swechar(s: str) -> str:
-    return "".join(token_to_swechar(ord(c)) for c in s)
+    try:
+        return s.encode("latin-1").translate(SWECHAR_BYTES_TRANSLATION).decode("latin-1")
+    except UnicodeEncodeError:
+        return s.translate(SWECHAR_TRANSLATION)
 
 def str_from_swechar(s: str) -> str:
-    return "".join(token_from_swechar(ord(c)) for c in s)
+    try:
+        return s.encode("latin-1").translate(SWECHAR_BYTES_INVERSE_TRANSLATION).decode("latin-1")
+    except UnicodeEncodeError:
+        return s.translate(SWECHAR_INVERSE_TRANSLATION)
 
 
+# Bytes are characters 0-255, i.e. latin-1
 def bytes_to_swechar(bstr: bytes) -> str:
-    return "".join(token_to_swechar(byte) for byte in bstr)
+    return bytes(bstr).translate(SWECHAR_BYTES_TRANSLATION).decode("latin-1")
 
 def bytes_from_swechar(bstr: bytes) -> str:
-    return "".join(token_from_swechar(byte) for byte in bstr)
+    return bytes(bstr).translate(SWECHAR_BYTES_INVERSE_TRANSLATION).decode("latin-1")
+
+
+# Bulk versions, for whole listings or tables of filenames
+def listing_to_swechar(lines: Iterable[str]) -> List[str]:
+    return [str_to_swechar(line) for line in lines]
+
+def listing_from_swechar(lines: Iterable[str]) -> List[str]:
+    return [str_from_swechar(line) for line in lines]
 
 
 def token_to_swechar(token: int) -> str:
-    return SWE_CHARS.get(chr(token), chr(token))
+    if token < 256:
+        return _TOKENS_TO_SWECHAR[token]
+    return chr(token)
 
 def token_from_swechar(token: int) -> str:
+    if token < 256:
+        return _TOKENS_FROM_SWECHAR[token]
     return SWE_CHARS_INVERSE.get(chr(token), chr(token))
+
+
+def import_numpy():
+    # The numpy module, or None if it isn't installed
+    global _numpy
+    if _numpy is False:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = None
+    return _numpy
+
+
+@contextlib.contextmanager
+def atomic_write(filename: str) -> Iterator[str]:
+    # Yields the name of a temporary file next to filename to write to, which replaces filename when the
+    # with block completes, so an aborted run never leaves half a file. The file gets the same permissions
+    # as one created with open(), rather than the owner-only ones of mkstemp.
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), prefix='.tmp-')
+    os.close(fd)
+    try:
+        yield tmpname
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmpname, 0o666 & ~umask)
+        os.replace(tmpname, filename)
+    except BaseException:
+        os.unlink(tmpname)
+        raise
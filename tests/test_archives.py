@@ -0,0 +1,87 @@
+import os
+import io
+import tarfile
+import zipfile
+
+import pytest
+
+from sviit import archives, synthetic
+from sviit.disk import SIZE_SS
+from sviit.extract_basic_programs import archive_output_path
+from sviit.images import iter_sources, member_path
+
+
+@pytest.fixture
+def members(tmp_path):
+    ss = str(tmp_path / "ss.dsk")
+    ds = str(tmp_path / "ds.dsk")
+    synthetic.write_image(ss, seed=1)
+    synthetic.write_image(ds, seed=2, double_sided=True)
+    with open(ss, "rb") as f:
+        ss_data = f.read()
+    with open(ds, "rb") as f:
+        ds_data = f.read()
+    # Only members with the size of a disk image are images, whatever they are called
+    return [
+        ("disks/ss.dsk", ss_data),
+        ("readme.txt", b"hello"),
+        ("disks/short.dsk", ss_data[:SIZE_SS-1]),
+        ("disks/ds.img", ds_data),
+    ]
+
+EXPECTED = ["disks/ss.dsk", "disks/ds.img"]
+
+def test_zip(tmp_path, members):
+    filename = str(tmp_path / "disks.zip")
+    with zipfile.ZipFile(filename, "w") as archive:
+        archive.writestr("disks/", b"")
+        for name, data in members:
+            archive.writestr(name, data)
+    assert archives.is_archive(filename)
+    images = list(archives.archive_images(filename))
+    assert [name for name, _ in images] == EXPECTED
+    assert images == [(name, data) for name, data in members if name in EXPECTED]
+    assert list(iter_sources(filename)) == images
+
+@pytest.mark.parametrize("suffix, mode", [(".tar", "w"), (".tar.gz", "w:gz"), (".tbz2", "w:bz2")])
+def test_tar(tmp_path, members, suffix, mode):
+    filename = str(tmp_path / ("disks" + suffix))
+    with tarfile.open(filename, mode) as archive:
+        directory = tarfile.TarInfo("disks")
+        directory.type = tarfile.DIRTYPE
+        archive.addfile(directory)
+        for name, data in members:
+            info = tarfile.TarInfo("./" + name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    assert archives.is_archive(filename)
+    assert list(archives.archive_images(filename)) == [(name, data) for name, data in members if name in EXPECTED]
+
+def test_stop_reading_early(tmp_path, members):
+    filename = str(tmp_path / "disks.zip")
+    with zipfile.ZipFile(filename, "w") as archive:
+        for i in range(20):
+            archive.writestr("disk%02d.dsk" % i, members[0][1])
+    for name, _ in archives.archive_images(filename, size=2):
+        break
+    assert name == "disk00.dsk"
+
+def test_not_an_archive():
+    assert not archives.is_archive("disk.dsk")
+    assert archives.is_archive("DISKS.ZIP")
+    assert archives.is_archive("disks.tar.xz")
+
+@pytest.mark.parametrize("member, expected", [
+    ("disks/game.dsk", os.path.join("disks", "game.dsk")),
+    ("../../etc/game.dsk", os.path.join("etc", "game.dsk")),
+    ("/abs/game.dsk", os.path.join("abs", "game.dsk")),
+    ("disks\\sub\\game.dsk", os.path.join("disks", "sub", "game.dsk")),
+    ("..", "_"),
+])
+def test_member_path(member, expected):
+    assert member_path(member) == expected
+
+def test_archive_output_stays_below_the_output(tmp_path):
+    root = str(tmp_path / "out")
+    assert archive_output_path("../../evil.dsk", root) == os.path.join(root, "evil")
+    assert archive_output_path("a/b.dsk", root) == os.path.join(root, "a", "b")
@@ -0,0 +1,38 @@
+import random
+
+import pytest
+
+from sviit import basic_tokenizer, synthetic
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_tokenize_detokenize_round_trip(seed):
+    # Detokenizing adds type suffixes to the constants, so the listing itself doesn't come back,
+    # but tokenizing the detokenized listing must give the same program
+    program = basic_tokenizer.tokenize(synthetic.program_listing(random.Random(seed), 200))
+    listing = basic_tokenizer.detokenize(program)
+    assert basic_tokenizer.tokenize(listing) == program
+    assert basic_tokenizer.detokenize(basic_tokenizer.tokenize(listing)) == listing
+
+@pytest.mark.parametrize("data, expected", [
+    ("41100000", "1"),
+    ("40500000", "0.5"),
+    ("c1250000", "-2.5"),
+    ("43123456", "123.456"),
+    ("41314159", "3.14159"),
+    ("37100000", "1e-10"),
+    ("55100000", "1e+20"),
+    ("00000000", "0"),
+    ("4110000000000000", "1"),
+    ("c125000000000000", "-2.5"),
+    ("4131415926535898", "3.1415926535898"),
+    ("4f12345678901234", "1.2345678901234e+14"),
+    ("0000000000000000", "0"),
+])
+def test_decode_float(data, expected):
+    assert basic_tokenizer.decode_float(bytes.fromhex(data)) == expected
+    assert basic_tokenizer.decode_float(basic_tokenizer.encode_float(expected, len(data) == 16)) == expected
+
+def test_decode_float_not_bcd():
+    # Nibbles above 9 are weighed as digits anyway: 0.(10)(11)0000 * 10^1
+    assert basic_tokenizer.decode_float(bytes.fromhex("41ab0000")) == "11.1"
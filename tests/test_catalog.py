@@ -0,0 +1,46 @@
+import os
+
+import pytest
+
+from sviit import catalog, synthetic
+from sviit.disk import Disk
+
+
+def test_catalog_round_trip(tmp_path):
+    inpath = str(tmp_path / "in")
+    os.makedirs(os.path.join(inpath, "sub"))
+    images = {"a.dsk": 1, os.path.join("sub", "b.dsk"): 2}
+    for name, seed in images.items():
+        synthetic.write_image(os.path.join(inpath, name), seed=seed, double_sided=seed == 2)
+    with open(os.path.join(inpath, "broken.dsk"), "wb") as f:
+        f.write(b"not a disk")
+    catalog_file = str(tmp_path / "catalog")
+
+    num_images, num_entries, failed = catalog.build(inpath, catalog_file, workers=1)
+    assert num_images == 2
+    assert [image for image, _ in failed] == ["broken.dsk"]
+
+    expected = []
+    for name in sorted(images):
+        with Disk(os.path.join(inpath, name)) as disk:
+            expected += [(name, f.filename, f.type, f.size, f.deleted, f.tracks.tolist()) for f in disk.get_all_files()]
+    assert num_entries == len(expected)
+
+    with catalog.Catalog(catalog_file) as c:
+        assert len(c) == num_entries
+        assert c.num_images == 2
+        assert [c.entry(i) for i in range(len(c))] == expected
+        assert list(c.query(deleted=True)) == expected
+        assert list(c.query()) == [e for e in expected if not e[4]]
+        assert [e[:2] for e in c.query("PROG[12]")] == [("a.dsk", "prog1"), ("a.dsk", "prog2"),
+                                                        (os.path.join("sub", "b.dsk"), "prog1"),
+                                                        (os.path.join("sub", "b.dsk"), "prog2")]
+        assert all(e[2] & 0xA1 == 0x80 for e in c.query(basic=True))
+        assert "data" not in [e[1] for e in c.query(basic=True)]
+
+def test_not_a_catalog(tmp_path):
+    filename = str(tmp_path / "catalog")
+    with open(filename, "wb") as f:
+        f.write(bytes(64))
+    with pytest.raises(Exception, match="is not a catalog"):
+        catalog.Catalog(filename)
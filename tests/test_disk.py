@@ -0,0 +1,50 @@
+import os
+import random
+
+import pytest
+
+from sviit import basic_tokenizer, synthetic
+from sviit.disk import Disk
+
+
+def read(filename):
+    with open(filename, "rb") as f:
+        return f.read()
+
+@pytest.mark.parametrize("double_sided", [False, True])
+@pytest.mark.parametrize("use_mmap", [False, True])
+def test_incremental_save_matches_full_write(tmp_path, double_sided, use_mmap):
+    image = str(tmp_path / "image.dsk")
+    synthetic.write_image(image, seed=1, double_sided=double_sided)
+
+    with Disk(image, use_mmap=use_mmap) as disk:
+        with disk.edit() as tx:
+            tx.delete_file("prog1")
+            tx.create_file("new", 0x80, basic_tokenizer.tokenize(synthetic.program_listing(random.Random(2), 100)))
+        last = disk.no_tracks() - 1
+        disk.tracks[last] = bytes([0x42]) * len(disk.tracks[last])
+        disk.save_to_file(image)
+        disk.save_to_file(str(tmp_path / "full.dsk"))
+
+    assert read(image) == read(tmp_path / "full.dsk")
+    with Disk(image) as disk:
+        assert "new" in [f.filename for f in disk.get_files()]
+        assert "prog1" not in [f.filename for f in disk.get_files()]
+
+def test_save_after_the_image_is_gone(tmp_path):
+    image = str(tmp_path / "image.dsk")
+    other = str(tmp_path / "other.dsk")
+    synthetic.write_image(image, seed=1)
+    synthetic.write_image(other, seed=2)
+
+    disk = Disk(image)
+    os.unlink(image)
+    disk.save_to_file(other)
+    assert read(other) == b"".join(bytes(disk.tracks[trk]) for trk in range(disk.no_tracks()))
+
+def test_committed_tracks_are_mutable():
+    disk = synthetic.generate_disk(1)
+    with disk.edit() as tx:
+        tx.delete_file("prog1")
+    assert isinstance(disk.tracks[20], bytearray)
+    assert 20 in disk.get_dirty_tracks()
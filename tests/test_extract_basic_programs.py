@@ -0,0 +1,73 @@
+import os
+
+from sviit import basic_tokenizer, synthetic
+from sviit.disk import Disk
+from sviit.extract_basic_programs import extract_all
+from sviit.manifest import Manifest
+
+
+def make_collection(root):
+    os.makedirs(os.path.join(root, "sub"))
+    synthetic.write_image(os.path.join(root, "a.dsk"), seed=1)
+    synthetic.write_image(os.path.join(root, "sub", "b.dsk"), seed=2, double_sided=True)
+
+def run(inpath, outpath, manifest):
+    results = extract_all(inpath, outpath, workers=1, manifest_file=manifest)
+    assert [error for _, _, error in results] == [None] * len(results)
+    return sum(extracted for _, extracted, _ in results)
+
+def outputs(outpath):
+    return sorted(os.path.relpath(os.path.join(root, f), outpath) for root, _, files in os.walk(outpath) for f in files)
+
+
+def test_manifest_skips_unchanged_images(tmp_path):
+    inpath, outpath, manifest = str(tmp_path / "in"), str(tmp_path / "out"), str(tmp_path / "manifest.db")
+    make_collection(inpath)
+
+    extracted = run(inpath, outpath, manifest)
+    assert extracted == 10
+    assert len(outputs(outpath)) == extracted
+    assert run(inpath, outpath, manifest) == 0
+
+    with Manifest(manifest) as m:
+        images = m.get_images()
+    assert sorted(images) == ["a.dsk", os.path.join("sub", "b.dsk")]
+    assert sorted(images["a.dsk"].files) == ["loop", "prog1", "prog2", "prog4", "prog5"]
+
+def test_manifest_extracts_changed_programs(tmp_path):
+    inpath, outpath, manifest = str(tmp_path / "in"), str(tmp_path / "out"), str(tmp_path / "manifest.db")
+    make_collection(inpath)
+    run(inpath, outpath, manifest)
+
+    image = os.path.join(inpath, "a.dsk")
+    with Disk(image) as disk:
+        with disk.edit() as tx:
+            tx.delete_file("prog1")
+            tx.create_file("prog1", 0x80, basic_tokenizer.tokenize(["10 PRINT \"CHANGED\""]))
+        disk.save_to_file(image)
+    assert run(inpath, outpath, manifest) == 1
+    with open(os.path.join(outpath, "a", "prog1")) as f:
+        assert f.read() == "10 PRINT \"CHANGED\"\n"
+
+def test_manifest_removes_outputs_of_removed_images(tmp_path):
+    inpath, outpath, manifest = str(tmp_path / "in"), str(tmp_path / "out"), str(tmp_path / "manifest.db")
+    make_collection(inpath)
+    run(inpath, outpath, manifest)
+
+    os.unlink(os.path.join(inpath, "sub", "b.dsk"))
+    assert run(inpath, outpath, manifest) == 0
+    assert outputs(outpath) == [os.path.join("a", name) for name in ["loop", "prog1", "prog2", "prog4", "prog5"]]
+    with Manifest(manifest) as m:
+        assert sorted(m.get_images()) == ["a.dsk"]
+
+def test_manifest_extracts_again_when_the_output_is_gone(tmp_path):
+    inpath, outpath, manifest = str(tmp_path / "in"), str(tmp_path / "out"), str(tmp_path / "manifest.db")
+    make_collection(inpath)
+    run(inpath, outpath, manifest)
+
+    os.unlink(os.path.join(outpath, "a", "prog2"))
+    assert run(inpath, outpath, manifest) == 1
+    assert os.path.exists(os.path.join(outpath, "a", "prog2"))
+
+    # Extracting somewhere else doesn't reuse what was written to the first output
+    assert run(inpath, str(tmp_path / "other"), manifest) == 10
@@ -0,0 +1,141 @@
+import os
+
+import pytest
+
+from sviit import fsck, synthetic
+from sviit.disk import Disk, FAT_FREE, fat_copies, majority_fat
+from sviit.images import ImageWorker
+
+
+def make_disk(files, links=None):
+    # A disk with files on the given tracks, and the FAT entries in links changed afterwards
+    disk = Disk.from_tracks(synthetic.formatted_tracks())
+    with disk.edit() as tx:
+        for name, tracks in files:
+            tx.create_file_from_tracks(name, 0x80, tracks)
+        for trk, value in (links or {}).items():
+            tx.fat[trk] = value
+    return disk
+
+def problems(report):
+    return [(p["problem"], p["file"], p["track"], p["previous"]) for p in report["problems"]]
+
+def chain(disk, name):
+    return disk.get_file(name).tracks.tolist()
+
+
+def test_majority_fat():
+    a = bytes(range(256))
+    b = bytearray(a)
+    b[3] = 0
+    c = bytearray(a)
+    c[3] = 0
+    c[7] = 0
+    d = bytearray(a)
+    d[7] = 1
+    assert majority_fat([a, a, a]) == (a, [])
+    assert majority_fat([a, b, c]) == (bytes(b), [3, 7])
+    # At 3 the first and last copies agree, at 7 all three differ and the first copy wins
+    assert majority_fat([a, c, d]) == (a, [3, 7])
+
+def test_clean_disk():
+    report = fsck.check(make_disk([("a", [3, 4]), ("b", [5])]))
+    assert report["has_fat"]
+    assert report["problems"] == []
+    assert not fsck.is_damaged(report)
+
+def test_one_bad_fat_copy():
+    disk = make_disk([("a", [3, 4])])
+    track = bytearray(disk.tracks[20])
+    track[16*256+4] = 9
+    track[16*256] = 0
+    disk.tracks[20] = track
+    assert disk.has_fat()
+    report = fsck.check(disk)
+    assert report["has_fat"]
+    assert report["fat_mismatches"] == 2
+    assert report["bad_fat_copies"] == [2]
+    assert fsck.is_damaged(report)
+
+    fsck.repair(disk, report)
+    copies = fat_copies(disk.tracks[20])
+    assert copies[0] == copies[1] == copies[2]
+    assert chain(disk, "a") == [3, 4]
+
+def test_cross_linked():
+    disk = make_disk([("a", [3, 4, 5]), ("b", [6])], {6: 4})
+    report = fsck.check(disk)
+    assert problems(report) == [(fsck.CROSS_LINKED, "b", 4, 6)]
+    assert report["problems"][0]["other"] == "a"
+
+    fsck.repair(disk, report)
+    assert problems(fsck.check(disk)) == []
+    assert chain(disk, "a") == [3, 4, 5]
+    assert chain(disk, "b") == [6]
+
+def test_chain_into_the_first_track_of_a_later_file():
+    # b comes first in the directory, but a's first track still belongs to a
+    disk = make_disk([("b", [6]), ("a", [3, 4])], {6: 3})
+    report = fsck.check(disk)
+    assert problems(report) == [(fsck.CROSS_LINKED, "b", 3, 6)]
+
+    fsck.repair(disk, report)
+    assert problems(fsck.check(disk)) == []
+    assert chain(disk, "a") == [3, 4]
+    assert chain(disk, "b") == [6]
+
+def test_circular():
+    disk = make_disk([("a", [3, 4, 5])], {5: 3})
+    report = fsck.check(disk)
+    assert problems(report) == [(fsck.CIRCULAR, "a", 3, 5)]
+
+    fsck.repair(disk, report)
+    assert problems(fsck.check(disk)) == []
+    assert chain(disk, "a") == [3, 4, 5]
+
+def test_out_of_range_and_system_track():
+    disk = make_disk([("a", [3, 4]), ("b", [5])], {4: 60, 5: 20})
+    report = fsck.check(disk)
+    assert problems(report) == [(fsck.OUT_OF_RANGE, "a", 60, 4), (fsck.SYSTEM_TRACK, "b", 20, 5)]
+
+    fsck.repair(disk, report)
+    assert problems(fsck.check(disk)) == []
+    assert chain(disk, "a") == [3, 4]
+    assert chain(disk, "b") == [5]
+
+def test_lost_track():
+    disk = make_disk([("a", [3])], {9: 0xD1})
+    report = fsck.check(disk)
+    assert problems(report) == [(fsck.LOST_TRACK, None, 9, None)]
+
+    fsck.repair(disk, report)
+    assert problems(fsck.check(disk)) == []
+    assert disk._get_directory()[2][9] == FAT_FREE
+
+def test_repaired_copy(tmp_path):
+    image = str(tmp_path / "image.dsk")
+    output = str(tmp_path / "repaired" / "image.dsk")
+    make_disk([("a", [3, 4, 5])], {5: 3}).save_to_file(image)
+    with open(image, "rb") as f:
+        original = f.read()
+
+    umask = os.umask(0o022)
+    try:
+        name, report, error = ImageWorker(fsck.fsck_image, "check", None)(("image.dsk", image, output))
+    finally:
+        os.umask(umask)
+    assert error is None
+    assert report["repaired"] == output
+    assert os.stat(output).st_mode & 0o777 == 0o644
+    with open(image, "rb") as f:
+        assert f.read() == original
+    with Disk(output) as disk:
+        assert problems(fsck.check(disk)) == []
+
+@pytest.mark.parametrize("output", ["image.dsk", "./image.dsk"])
+def test_never_replaces_the_original(tmp_path, output):
+    image = str(tmp_path / "image.dsk")
+    make_disk([("a", [3, 4, 5])], {5: 3}).save_to_file(image)
+    name, report, error = ImageWorker(fsck.fsck_image, "check", None)(("image.dsk", image, str(tmp_path / output)))
+    assert report is None
+    assert error is not None
@@ -0,0 +1,63 @@
+import os
+import json
+
+from sviit import basic_tokenizer, recovery, synthetic
+from sviit.disk import Disk
+
+PROGRAM = basic_tokenizer.tokenize(["10 PRINT \"HELLO\"", "20 GOTO 10"])
+# Where the second line starts
+SECOND = PROGRAM[0] + PROGRAM[1] * 256 - recovery.LOAD_ADDRESS
+
+
+def test_carve_complete_program():
+    assert recovery.carve_program(PROGRAM + b"garbage") == (len(PROGRAM) - 2, 2, recovery.CARVE_COMPLETE)
+
+def test_carve_truncated_program():
+    assert recovery.carve_program(PROGRAM[:-4]) == (SECOND, 1, recovery.CARVE_TRUNCATED)
+    assert recovery.carve_program(PROGRAM[:1]) == (0, 0, recovery.CARVE_TRUNCATED)
+
+def test_carve_broken_program():
+    # The second line points backwards
+    data = bytearray(PROGRAM)
+    data[SECOND:SECOND+2] = b"\x01\x80"
+    assert recovery.carve_program(data) == (SECOND, 1, recovery.CARVE_BROKEN)
+    # Line numbers must increase
+    data = bytearray(PROGRAM)
+    data[SECOND+2:SECOND+4] = b"\x05\x00"
+    assert recovery.carve_program(data) == (SECOND, 1, recovery.CARVE_BROKEN)
+    assert recovery.carve_program(b"\xff" * 100) == (0, 0, recovery.CARVE_BROKEN)
+
+def test_recover_deleted_files_with_the_same_name(tmp_path):
+    image = str(tmp_path / "image.dsk")
+    output_path = str(tmp_path / "out")
+    disk = Disk.from_tracks(synthetic.formatted_tracks())
+    with disk.edit() as tx:
+        for trk, text in ((30, "FIRST"), (31, "SECOND")):
+            tx.write_track(trk, basic_tokenizer.tokenize(["10 PRINT \"%s\"" % text]))
+            tx.create_file_from_tracks("game", 0x80, [trk])
+            tx.delete_file("game")
+    disk.save_to_file(image)
+
+    report = recovery.recover(image, output_path)
+    deleted = [entry for entry in report if entry["source"] == "deleted"]
+    assert [entry["complete"] for entry in deleted] == [True, True]
+    assert len(set(entry["output"] for entry in deleted)) == 2
+    listings = []
+    for entry in deleted:
+        with open(os.path.join(output_path, entry["output"])) as f:
+            listings.append(f.read())
+        with open(os.path.join(output_path, entry["output"] + ".bin"), "rb") as f:
+            assert basic_tokenizer.detokenize(f.read()) == listings[-1].splitlines()
+    assert sorted(listings) == ["10 PRINT \"FIRST\"\n", "10 PRINT \"SECOND\"\n"]
+
+def test_recover_all_writes_a_report(tmp_path):
+    inpath = str(tmp_path / "in")
+    os.makedirs(inpath)
+    synthetic.write_image(os.path.join(inpath, "a.dsk"), seed=1)
+    report, failed = recovery.recover_all(inpath, str(tmp_path / "out"), workers=1)
+    assert failed == []
+    # The synthetic images have prog0 and prog3 deleted
+    assert [(entry["output"], entry["complete"]) for entry in report if entry["source"] == "deleted"] == \
+        [(os.path.join("a", "deleted_000_rog0"), True), (os.path.join("a", "deleted_003_rog3"), True)]
+    with open(os.path.join(str(tmp_path / "out"), recovery.REPORT_FILE)) as f:
+        assert json.load(f)["candidates"] == report